@@ -4,20 +4,11 @@ import numpy as np
 from utils.extract_transform import *
 from utils.inference import *
 from utils.charts import *
+from utils.profiling import *
+from utils.artifacts import *
 
-# Load and clean dataframes
-portfolio_df = cachedLoadAndCleanPortfolio()
-profile, profile_df = cachedLoadAndCleanProfile(return_raw=True)
-transcript_df = cachedLoadAndCleanTranscript()
-
-# Create demographic groups
-demographics = createDemographicGroups(profile)
-# Feature engineering
-transcript_feats = cachedCreateTranscriptFeatures(transcript_df, portfolio_df, profile_df)
-# Create target
-Y_df = cachedCreateTargets(transcript_feats, portfolio_df)
-# Create full dataset for model fitting
-df_full, df = getTrainingDataset(transcript_feats, Y_df, return_df_full=True)
+# Artifacts are built lazily by the pages that use them (see utils/artifacts.py)
+portfolio_df = getArtifact("portfolio_df")
 
 # Page options
 pages = [
@@ -26,46 +17,51 @@ pages = [
   "Offer Responsiveness - Descriptive Approach",
   "Offer Responsiveness - Predictive Approach"
 ]
+# Diagnostics page is only available when profiling is enabled (STARBUCKS_PROFILING=1)
+if profilingEnabled():
+  pages.append("Diagnostics")
 page = st.sidebar.radio("Select page", pages)
 
 # Page contents
 st.title(page)
 if page == "Offers Portfolio":
-  promo_funnel = getPromoFunnel(transcript_df, portfolio_df)
+  promo_funnel, offer_dist = getArtifacts("promo_funnel", "offer_dist")
 
   st.header("Offer Funnel")
   st.plotly_chart(promoFunnelFig(promo_funnel))
   st.write("Note that customers can complelte an offer without ever viewing it.")
 
   st.header("Sent Offers Distribution (deviation from uniform distribution)")
-  offer_dist = getOffersDist(transcript_df, portfolio_df)
   st.plotly_chart(sentOffersDistributionFig(offer_dist))
 
   st.header("Data")
   st.write(promo_funnel)
 
 elif page == "Demographic Groups":
+  demographics = getArtifact("demographics")
+  group_dists, hists = getArtifact("demographic_dists")
   st.header("Distribution of Demographic Groups")
 
   col1, col2 = st.columns(2)
   demog_feat = col2.radio("Demographic Feature", ["Age","Income","Cohort","Gender"])
-  col1.pyplot(demographicDistributionBarH(demographics, demog_feat))
+  col1.pyplot(demographicDistributionBarH(group_dists, demog_feat))
 
   if demog_feat != "Gender":
-    st.plotly_chart(demographicDistributionHist(demographics, demog_feat))
+    st.plotly_chart(demographicDistributionHist(hists, demog_feat))
 
   st.header("Data")
   st.write(demographics.head(50))
 
 elif page == "Offer Responsiveness - Descriptive Approach":
-  time_windows = sorted(24*portfolio_df["duration"].unique())
-  demog_spendings, spendings = createSpendingsPerGroup(df_full, demographics, time_windows, return_raw=True)
+  demographics, spendings_cube = getArtifacts("demographics", "spendings_cube")
+  demog_spendings, spendings = getArtifact("demog_spendings")
+  spendings_stats = getArtifact("spendings_stats")
   feat_cols = ["age_group", "income_group", "cohort_group", "gender", "offer_code"]
 
   st.header("Spendings per Demographic Feature")
   col1, col2 = st.columns(2)
   feat = col2.radio("Demographic Feature", feat_cols)
-  col1.pyplot(spendingsPerDemographicsBar(demog_spendings, feat))
+  col1.pyplot(spendingsPerDemographicsBar(spendings_stats, feat))
 
   st.header("Best Demographic Groups per Offer")
   st.write("Select the features for defining the demographic groups")
@@ -82,7 +78,7 @@ elif page == "Offer Responsiveness - Descriptive Approach":
   demog_feats = zip(feat_cols[:-1], [cb_age, cb_income, cb_cohort, cb_gender])
   demog_feats = [f for f,use in demog_feats if use]
 
-  spendings_offers = spendingsForOffers(demog_spendings, offer_types, demog_feats, min_group_size)
+  spendings_offers = spendingsForOffers(demog_spendings, offer_types, demog_feats, min_group_size, spendings_cube)
   spendings_offers = spendings_offers.style.bar(subset=["spending_median"], color="#F63366")
   st.write(spendings_offers)
 
@@ -106,7 +102,7 @@ elif page == "Offer Responsiveness - Descriptive Approach":
     cohort = st.selectbox("Cohort Group", spendings["cohort_group"].unique(), key="GroupsCohort")
     if cb_cohort: group_def.append(("cohort_group", cohort))
 
-  metrics = getGroupStats(group_def, demographics, demog_spendings)
+  metrics = getGroupStats(group_def, demographics, demog_spendings, spendings_cube)
   n_customers, n_offers_sent, n_unique_offers = metrics
   col1, col2, col3 = st.columns(3)
   col1.metric("Customers in Group", n_customers)
@@ -114,28 +110,70 @@ elif page == "Offer Responsiveness - Descriptive Approach":
   col3.metric("Offer Types Sent", n_unique_offers)
 
   st.markdown("**Top 5 Offers to Send to Demographic Group**")
-  best_offers = bestOfferForGroup(demog_spendings, portfolio_df, group_def)
+  best_offers = bestOfferForGroup(demog_spendings, portfolio_df, group_def, spendings_cube)
   best_offers = best_offers.style.bar(subset=["spending_median"], color="#F63366")
   st.write(best_offers)
 
 
 elif page == "Offer Responsiveness - Predictive Approach":
   models = loadModels()
+  profile_df = getArtifact("profile_df")
+  transcript_df, transcript_index = getArtifact("indexed_transcript")
+  transcript_feats, feats_index = getArtifact("indexed_feats")
 
   st.header("Spending Inference")
   person = st.selectbox("Select the customer", profile_df["person"])
   last_sim_time = int(transcript_df["time"].max())
   time = st.slider("Time to send offer", last_sim_time+1, 800)
 
-  with st.expander("See Customer Timeline and Features"):
-    st.subheader("Customer Timeline")
-    st.write(getCustomerTimeline(transcript_df, person))
+  # Customers without events have no features to predict from
+  if person not in feats_index.index:
+    st.write("The customer has no events to predict the spendings from.")
+  else:
+    with st.expander("See Customer Timeline and Features"):
+      st.subheader("Customer Timeline")
+      st.write(getCustomerTimeline(transcript_df, person, transcript_index))
+
+      st.subheader("Customer Features")
+      customerFeats = getCustomerFeatures(person, time, transcript_feats, portfolio_df, feats_index)
+      st.write(dropAuxFeatures(customerFeats))
+
+    st.subheader("Spending Predictions")
+    customerSpendings = predictCustomerSpendings(customerFeats)
+    customerSpendings = customerSpendings.style.background_gradient("rocket")
+    st.write(customerSpendings)
+
+elif page == "Diagnostics":
+  profile_records = getProfileRecords()
+
+  st.header("Time and Memory per Function")
+  if profile_records.empty:
+    st.write("No calls recorded yet.")
+  else:
+    # Peak RSS deltas of calls overlapping calls of other threads are left out (the peak is shared by
+    # the threads and reset by each of them)
+    profile_records["reliable_peak_rss_delta_mb"] = profile_records["peak_rss_delta_mb"].where(
+      profile_records["peak_rss_reliable"])
+    summary = profile_records.groupby("function").agg(
+      calls=("wall_time_s", "size"),
+      wall_time_s=("wall_time_s", "sum"),
+      cpu_time_s=("cpu_time_s", "sum"),
+      max_peak_rss_delta_mb=("reliable_peak_rss_delta_mb", "max"),
+      unreliable_rss_calls=("peak_rss_reliable", lambda reliable: int((~reliable).sum())),
+      max_input_rows=("input_rows", "max"),
+      max_output_rows=("output_rows", "max"),
+    ).sort_values("wall_time_s", ascending=False)
+    st.write(summary)
+    st.caption("The peak RSS deltas of the calls that overlapped instrumented calls of other threads "
+               "(e.g. the artifacts built in the background) are unreliable and left out of the maximum.")
+
+    st.header("Calls")
+    st.write(profile_records.drop(columns="reliable_peak_rss_delta_mb"))
 
-    st.subheader("Customer Features")
-    customerFeats = getCustomerFeatures(person, time, transcript_feats, portfolio_df)
-    st.write(dropAuxFeatures(customerFeats))
+  col1, col2 = st.columns(2)
+  col1.download_button("Export JSON lines", exportProfileRecords(), file_name="profile.jsonl")
+  if col2.button("Clear records"):
+    clearProfileRecords()
 
-  st.subheader("Spending Predictions")
-  customerSpendings = predictCustomerSpendings(customerFeats)
-  customerSpendings = customerSpendings.style.background_gradient("rocket")
-  st.write(customerSpendings)
+# Build the artifacts of the other pages in the background once this page is shown
+warmArtifacts()
@@ -0,0 +1,141 @@
+""" Scaling benchmark of the ETL and inference pipeline on synthetic datasets
+
+Reports the wall time and peak memory (linux peak RSS) of each stage for each scale of the base number of
+customers, e.g.:
+
+  python benchmark.py --scales 1 10 100 --output bench.jsonl
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from utils.extract_transform import *
+from utils.inference import *
+from utils.parallel import *
+from utils.profiling import readMemoryStatus, resetPeakMemory
+from utils.synthetic import writeSyntheticDataset
+
+
+def measureStage(results, scale, stage, func, *args, **kwargs):
+  """ Runs a stage recording its wall time and peak memory (peak RSS above the RSS at its start),
+  and returns its output
+  """
+
+  # Reset the peak RSS of the process (linux)
+  resetPeakMemory()
+  start_memory = readMemoryStatus("VmRSS")
+
+  start = time.perf_counter()
+  output = func(*args, **kwargs)
+  wall_time = time.perf_counter() - start
+  peak_memory = readMemoryStatus("VmHWM") - start_memory
+
+  results.append({
+    "scale": scale,
+    "stage": stage,
+    "wall_time_s": round(wall_time, 3),
+    "peak_memory_mb": round(peak_memory, 1),
+  })
+  print(f"  {stage:<28} {wall_time:>9.2f} s {peak_memory:>10.1f} MB", flush=True)
+
+  return output
+
+
+def runBenchmark(scale, n_customers, n_hours, seed, predict_fraction, data_dir, demographic_bins, compact=False,
+                 n_jobs=1):
+  """ Generates a synthetic dataset for the scale and measures every stage of the pipeline on it
+  (in the compact schema if set, and the features and targets in n_jobs processes if more than one)
+  """
+
+  results = []
+  scale_dir = os.path.join(data_dir, f"scale_{scale}")
+  n_scale_customers = int(scale*n_customers)
+
+  print(f"Scale {scale}x ({n_scale_customers} customers, {n_hours} hours)", flush=True)
+  measureStage(results, scale, "generate", writeSyntheticDataset, scale_dir, n_scale_customers, n_hours, seed)
+
+  portfolio_df = loadAndCleanPortfolio(os.path.join(scale_dir, "portfolio.json"))
+  profile, profile_df = loadAndCleanProfile(True, os.path.join(scale_dir, "profile.json"))
+  id_dtypes = None
+  if compact:
+    id_dtypes = createIdDtypes(portfolio_df, profile_df)
+    portfolio_df = compactFrame(portfolio_df, id_dtypes)
+    profile_df = compactFrame(profile_df, id_dtypes)
+
+  transcript_df = measureStage(results, scale, "loadAndCleanTranscript",
+    loadAndCleanTranscript, os.path.join(scale_dir, "transcript.json"), id_dtypes=id_dtypes)
+  if n_jobs > 1:
+    transcript_feats = measureStage(results, scale, "createTranscriptFeatures",
+      createTranscriptFeaturesParallel, transcript_df, portfolio_df, profile_df, n_jobs)
+    Y_df = measureStage(results, scale, "createTargets", createTargetsParallel, transcript_feats, portfolio_df, n_jobs)
+  else:
+    transcript_feats = measureStage(results, scale, "createTranscriptFeatures",
+      createTranscriptFeatures, transcript_df, portfolio_df, profile_df)
+    Y_df = measureStage(results, scale, "createTargets", createTargets, transcript_feats, portfolio_df)
+  df_full, df = measureStage(results, scale, "getTrainingDataset",
+    getTrainingDataset, transcript_feats, Y_df, return_df_full=True)
+
+  # Group the customers with the demographic bins fitted on the original data (the cohort breaks
+  # heuristic may not find the 4 cohorts in other sizes)
+  demographics = measureStage(results, scale, "createDemographicGroups",
+    createDemographicGroups, profile, demographic_bins)
+  time_windows = sorted(24*portfolio_df["duration"].unique())
+  measureStage(results, scale, "createSpendingsPerGroup",
+    createSpendingsPerGroup, df_full, demographics, time_windows)
+
+  # Predict the spendings of a sample of the customers for every offer
+  loadModels()
+  rng = np.random.default_rng(seed)
+  customers = transcript_df["person"].unique()
+  customers = rng.choice(customers, max(1, int(predict_fraction*len(customers))), replace=False)
+  send_time = int(transcript_df["time"].max()) + 1
+  transcript_feats, feats_index = createPersonIndex(transcript_feats)
+  measureStage(results, scale, "predictCustomersSpendings",
+    predictCustomersSpendings, customers, send_time, transcript_feats, portfolio_df, feats_index)
+
+  for result in results:
+    result.update({
+      "customers": n_scale_customers, "hours": n_hours, "events": transcript_df.shape[0], "compact": compact,
+      "jobs": n_jobs,
+    })
+
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Scaling benchmark of the ETL and inference pipeline")
+  parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100])
+  parser.add_argument("--customers", type=int, default=17000, help="customers at scale 1")
+  parser.add_argument("--hours", type=int, default=714, help="simulated hours")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--predict-fraction", type=float, default=0.1, help="share of customers to predict")
+  parser.add_argument("--compact", action="store_true", help="run the pipeline in the compact schema")
+  parser.add_argument("--jobs", type=int, default=1, help="processes for the features and targets")
+  parser.add_argument("--data-dir", help="folder to keep the synthetic datasets (temporary if not set)")
+  parser.add_argument("--output", help="json lines file to write the results to")
+  args = parser.parse_args()
+
+  # Demographic bins saved with the models (or fitted on the original profiles, without saving them)
+  if os.path.exists(demographic_bins_path):
+    demographic_bins = loadDemographicBins()
+  else:
+    demographic_bins = fitDemographicBins(loadAndCleanProfile(True)[0])
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    data_dir = args.data_dir or tmp_dir
+    results = []
+    for scale in args.scales:
+      scale = int(scale) if float(scale).is_integer() else scale
+      results += runBenchmark(scale, args.customers, args.hours, args.seed, args.predict_fraction, data_dir,
+        demographic_bins, args.compact, args.jobs)
+
+  summary = pd.DataFrame(results).pivot(index="stage", columns="scale", values=["wall_time_s", "peak_memory_mb"])
+  print(summary.to_string())
+
+  if args.output:
+    with open(args.output, "w") as handle:
+      for result in results:
+        handle.write(json.dumps(result) + "\n")
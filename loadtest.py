@@ -0,0 +1,129 @@
+""" Latency and throughput load test of the scoring service
+
+Sends (person, time) scoring requests from concurrent clients for a fixed duration and reports the
+throughput and latency percentiles, starting a local service unless a url is given, e.g.:
+
+  python loadtest.py --concurrency 32 --duration 20
+  python loadtest.py --url http://127.0.0.1:8000 --concurrency 64
+"""
+import argparse
+import http.client
+import json
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import numpy as np
+import pandas as pd
+
+
+def waitForService(url, timeout=600):
+  """ Waits until the service answers its health check
+  """
+
+  start = time.perf_counter()
+  while time.perf_counter() - start < timeout:
+    try:
+      with urllib.request.urlopen(f"{url}/health", timeout=1) as response:
+        return json.load(response)
+    except OSError:
+      time.sleep(0.5)
+  raise TimeoutError(f"Scoring service at {url} not available after {timeout} s")
+
+
+def runClient(url, persons, times, end_time, latencies, errors, seed):
+  """ Sends scoring requests of random customers over a keep alive connection until the end time,
+  appending the latency (in seconds) of each successful request
+  """
+
+  rng = np.random.default_rng(seed)
+  parsed_url = urllib.parse.urlparse(url)
+  connection = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port)
+  while time.perf_counter() < end_time:
+    i = rng.integers(len(persons))
+    body = json.dumps({"person": persons[i], "time": int(times[i])})
+
+    start = time.perf_counter()
+    try:
+      connection.request("POST", "/score", body, {"Content-Type": "application/json"})
+      response = connection.getresponse()
+      response.read()
+    except (OSError, http.client.HTTPException) as error:
+      errors.append(type(error).__name__)
+      connection.close()
+      continue
+    latency = time.perf_counter() - start
+
+    if response.status == 200:
+      latencies.append(latency)
+    else:
+      errors.append(response.status)
+  connection.close()
+
+
+def runLoadTest(url, persons, times, concurrency, duration, warmup=2):
+  """ Returns the throughput and latency percentiles of concurrent clients scoring for the duration
+  (after a warm up)
+  """
+
+  latencies, errors = [], []
+  for phase_duration, phase_latencies, phase_errors in [(warmup, [], []), (duration, latencies, errors)]:
+    end_time = time.perf_counter() + phase_duration
+    clients = [
+      threading.Thread(target=runClient, args=(url, persons, times, end_time, phase_latencies, phase_errors, seed))
+      for seed in range(concurrency)
+    ]
+    for client in clients:
+      client.start()
+    for client in clients:
+      client.join()
+
+  latencies_ms = 1000*np.array(latencies)
+  return {
+    "concurrency": concurrency,
+    "requests": len(latencies),
+    "errors": len(errors),
+    "throughput_rps": round(len(latencies) / duration, 1),
+    "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2),
+    "p95_ms": round(float(np.percentile(latencies_ms, 95)), 2),
+    "p99_ms": round(float(np.percentile(latencies_ms, 99)), 2),
+    "max_ms": round(float(latencies_ms.max()), 2),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Load test of the scoring service")
+  parser.add_argument("--url", help="url of a running service (a local one is started if not set)")
+  parser.add_argument("--port", type=int, default=8765, help="port of the local service")
+  parser.add_argument("--max-wait-ms", type=float, default=5, help="batching wait of the local service")
+  parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+  parser.add_argument("--duration", type=float, default=10, help="seconds of each load test")
+  parser.add_argument("--transcript", default="data/transcript.json", help="events of the customers to score")
+  args = parser.parse_args()
+
+  service = None
+  url = args.url
+  if url is None:
+    url = f"http://127.0.0.1:{args.port}"
+    service = subprocess.Popen([
+      sys.executable, "service.py", "--port", str(args.port), "--max-wait-ms", str(args.max_wait_ms)])
+
+  try:
+    waitForService(url)
+
+    # Customers with events, scored at a time after their last event
+    transcript = pd.read_json(args.transcript, orient="records", lines=True)
+    last_times = transcript.groupby("person")["time"].max()
+    persons = last_times.index.to_numpy()
+    times = last_times.max() + 1 + np.arange(len(persons)) % 72
+
+    for concurrency in args.concurrency:
+      result = runLoadTest(url, persons, times, concurrency, args.duration)
+      print(json.dumps(result), flush=True)
+    print(json.dumps(waitForService(url)), flush=True)
+  finally:
+    if service is not None:
+      service.terminate()
+      service.wait()
@@ -0,0 +1,29 @@
+""" Batch ranking of the offers for every customer
+
+Scores every offer in the portfolio sent to every customer at a given time and writes the predicted
+spendings of all time windows and the top k offers of each customer to parquet files, a chunk of
+customers at a time, e.g.:
+
+  python rank.py --time 720 --top-k 3 --output rankings
+"""
+import argparse
+import json
+from utils.inference import *
+from utils.ranking import *
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Batch ranking of the offers for every customer")
+  parser.add_argument("--time", type=int, help="time (hours) to send the offers (the hour after the last event if not set)")
+  parser.add_argument("--top-k", type=int, default=3, help="number of offers ranked per customer")
+  parser.add_argument("--window", type=int, default=max(inference_time_windows), choices=inference_time_windows,
+                      help="time window (hours) of the spending used to rank the offers")
+  parser.add_argument("--chunk-size", type=int, default=20000, help="customers scored at a time")
+  parser.add_argument("--model-version", default=default_model_version)
+  parser.add_argument("--output", default="rankings", help="folder of the results")
+  args = parser.parse_args()
+
+  state = loadInferenceState(args.model_version)
+  time = state["next_time"] if args.time is None else args.time
+  meta = writeRankings(args.output, state, time, args.top_k, args.window, args.chunk_size)
+  print(json.dumps(meta), flush=True)
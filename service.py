@@ -0,0 +1,262 @@
+""" Local HTTP scoring service of the customers' spendings for the offers
+
+Keeps the models and the customers' features loaded and scores POST /score requests with a json body:
+  - {"person": <id>, "time": <hour>}: spendings of every offer in the portfolio sent to the customer at
+    the time (the hour after the last event if not given)
+  - {"features": {<feature>: <value>, ...}}: spendings of a raw row of model features
+  - a list of the above, scored together: the response has a result per item (an object with the
+    error and status of each invalid item, with a 207 status if any)
+
+Requests arriving within a few milliseconds of each other are coalesced into a single batch, with one
+feature build and one prediction per time window model, e.g.:
+
+  python service.py --port 8000 --max-wait-ms 5
+  curl -d '{"person": "0610b486422d4921ae7d2bf64640c50b", "time": 720}' localhost:8000/score
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.extract_transform import *
+from utils.inference import *
+
+
+def scoreRequests(state, requests):
+  """ Returns the result of each scoring request (or the exception explaining why it is invalid),
+  building the features of all customers at once and predicting all rows together
+
+  Invalid requests fail alone: if the valid requests fail together, each one is scored on its own
+  so that only those failing get their exception.
+  """
+
+  results = [None] * len(requests)
+  customers, times, customer_requests = [], [], []
+  feature_rows, feature_requests = [], []
+  for i, request in enumerate(requests):
+    if not isinstance(request, dict):
+      results[i] = ValueError("Request must be a json object")
+    elif "features" in request:
+      if not isinstance(request["features"], dict):
+        results[i] = ValueError("Features must be a json object")
+        continue
+      missing_cols = [col for col in state["feature_cols"] if col not in request["features"]]
+      if missing_cols:
+        results[i] = ValueError(f"Missing features: {', '.join(missing_cols)}")
+        continue
+      try:
+        feature_row = pd.to_numeric(pd.Series([request["features"][col] for col in state["feature_cols"]],
+                                              index=state["feature_cols"], dtype=object))
+      except (ValueError, TypeError) as error:
+        results[i] = ValueError(f"Features must be numeric: {error}")
+      else:
+        feature_rows.append(feature_row.to_numpy(dtype=np.float64))
+        feature_requests.append(i)
+    elif "person" in request:
+      request_time = request.get("time", state["next_time"])
+      if not isinstance(request["person"], str) or request["person"] not in state["feats_index"].index:
+        results[i] = KeyError(f"Unknown person: {request['person']}")
+      elif not isinstance(request_time, int):
+        results[i] = ValueError("Time must be an integer (hours)")
+      else:
+        customers.append(request["person"])
+        times.append(request_time)
+        customer_requests.append(i)
+    else:
+      results[i] = ValueError("Request must have a person or features")
+
+  valid_requests = customer_requests + feature_requests
+  try:
+    predictRequests(state, customers, times, customer_requests, feature_rows, feature_requests, results)
+  except Exception as error:
+    if len(valid_requests) == 1:
+      results[valid_requests[0]] = error
+    else:
+      for i in valid_requests:
+        results[i] = scoreRequests(state, [requests[i]])[0]
+
+  return results
+
+
+def predictRequests(state, customers, times, customer_requests, feature_rows, feature_requests, results):
+  """ Sets the results of the valid requests of a batch: the spendings of every offer for the
+  customers at the times and of the raw feature rows, predicted together
+  """
+
+  # Model inputs: a row per customer and offer, followed by the raw feature rows
+  X_parts = []
+  if customers:
+    customers_feats = getCustomersFeatures(
+      customers, times, state["transcript_feats"], state["portfolio_df"], state["feats_index"])
+    X_parts.append(dropAuxFeatures(customers_feats))
+  if feature_rows:
+    X_parts.append(pd.DataFrame(np.vstack(feature_rows), columns=state["feature_cols"]))
+  if not X_parts:
+    return
+
+  X = pd.concat(X_parts, ignore_index=True)
+  spendings = predictSpendings(X, state["model_version"]).to_numpy(dtype=np.float64)
+  windows = [f"{time_window}h" for time_window in inference_time_windows]
+
+  # Split the predictions back into the requests
+  offer_codes = [str(code) for code in state["portfolio_df"]["code"]]
+  n_offers = len(offer_codes)
+  for j, i in enumerate(customer_requests):
+    customer_spendings = spendings[j*n_offers:(j+1)*n_offers]
+    results[i] = [
+      {"offer_code": code, **dict(zip(windows, offer_spendings.tolist()))}
+      for code, offer_spendings in zip(offer_codes, customer_spendings)
+    ]
+  first_row = len(customer_requests) * n_offers
+  for j, i in enumerate(feature_requests):
+    results[i] = dict(zip(windows, spendings[first_row + j].tolist()))
+
+
+class MicroBatcher:
+  """ Coalesces the requests submitted by concurrent threads within max_wait_ms of the first one (up
+  to max_batch_size requests) into a single call of the batch function, run in a worker thread
+  """
+
+  def __init__(self, batch_func, max_batch_size=256, max_wait_ms=5):
+    self.batch_func = batch_func
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self.requests = queue.Queue()
+    self.n_batches = 0
+    self.n_requests = 0
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def submit(self, request):
+    """ Returns a future of the result of a request, set once its batch is done (with its exception if
+    the request is invalid)
+    """
+
+    future = Future()
+    self.requests.put((request, future))
+    return future
+
+  def run(self):
+    while True:
+      batch = [self.requests.get()]
+      deadline = time.perf_counter() + self.max_wait_ms/1000
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - time.perf_counter()
+        try:
+          batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+        except queue.Empty:
+          break
+      self.n_batches += 1
+      self.n_requests += len(batch)
+
+      try:
+        results = self.batch_func([request for request, _ in batch])
+      except Exception as error:
+        results = [error] * len(batch)
+      for (_, future), result in zip(batch, results):
+        if isinstance(result, Exception):
+          future.set_exception(result)
+        else:
+          future.set_result(result)
+
+
+def getErrorResponse(error):
+  """ Returns the status and body of the response to a request that failed with the error
+  """
+
+  if isinstance(error, KeyError):
+    return 404, {"error": error.args[0]}
+  if isinstance(error, ValueError):
+    return 400, {"error": str(error)}
+  return 500, {"error": repr(error)}
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+  """ Handles the requests of the scoring service (the batcher is set on the server)
+  """
+
+  protocol_version = "HTTP/1.1"
+  # Send the responses of the keep alive connections without waiting for the previous ones to be acked
+  disable_nagle_algorithm = True
+
+  def sendJson(self, status, body):
+    content = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def do_GET(self):
+    if self.path == "/health":
+      batcher = self.server.batcher
+      self.sendJson(200, {
+        "status": "ok",
+        "batches": batcher.n_batches,
+        "mean_batch_size": batcher.n_requests / max(batcher.n_batches, 1),
+      })
+    else:
+      self.sendJson(404, {"error": "Not found"})
+
+  def do_POST(self):
+    if self.path != "/score":
+      self.sendJson(404, {"error": "Not found"})
+      return
+
+    try:
+      body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+    except ValueError:
+      self.sendJson(400, {"error": "Invalid json"})
+      return
+
+    if isinstance(body, list):
+      # Each item gets its own result, or its error and status in place of it (multi-status if any
+      # item failed)
+      futures = [self.server.batcher.submit(request) for request in body]
+      results = []
+      for future in futures:
+        if future.exception() is None:
+          results.append(future.result())
+        else:
+          status, error_body = getErrorResponse(future.exception())
+          results.append({"status": status, **error_body})
+      failed = any(future.exception() is not None for future in futures)
+      self.sendJson(207 if failed else 200, results)
+    else:
+      future = self.server.batcher.submit(body)
+      if future.exception() is None:
+        self.sendJson(200, future.result())
+      else:
+        self.sendJson(*getErrorResponse(future.exception()))
+
+  def log_message(self, *args):
+    pass
+
+
+class ScoringServer(ThreadingHTTPServer):
+  """ HTTP server handling each connection in a thread, with a backlog for bursts of clients
+  """
+
+  daemon_threads = True
+  request_queue_size = 128
+
+  def __init__(self, address, batcher):
+    super().__init__(address, ScoringHandler)
+    self.batcher = batcher
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local HTTP scoring service of the customers' spendings")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--model-version", default=default_model_version)
+  parser.add_argument("--max-batch-size", type=int, default=256)
+  parser.add_argument("--max-wait-ms", type=float, default=5, help="time to wait for requests to batch together")
+  args = parser.parse_args()
+
+  state = loadInferenceState(args.model_version)
+  batcher = MicroBatcher(lambda requests: scoreRequests(state, requests), args.max_batch_size, args.max_wait_ms)
+  server = ScoringServer((args.host, args.port), batcher)
+  print(f"Scoring service listening on http://{args.host}:{args.port}", flush=True)
+  server.serve_forever()
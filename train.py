@@ -0,0 +1,34 @@
+""" Training of the predictive models of the customers' spendings
+
+Trains a regressor per inference time window (in parallel, sharing a thread budget) on the training
+dataset of the cached pipeline stages, or on the one written by createTrainingDatasetOutOfCore, and
+writes them as a new version of the models read by the web app and the scoring service, e.g.:
+
+  python train.py --threads 8
+  python train.py --dataset training_dataset --version v3 --valid-fraction 0.2
+"""
+import argparse
+import json
+from utils.training import *
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Training of the predictive models of the customers' spendings")
+  parser.add_argument("--dataset", help="folder of the out of core training dataset (the cached stages if not set)")
+  parser.add_argument("--version", help="version of the models written (the next one if not set)")
+  parser.add_argument("--threads", type=int, help="thread budget of the training (all cpus if not set)")
+  parser.add_argument("--valid-fraction", type=float, default=0.2, help="fraction of the latest offers validated on")
+  parser.add_argument("--early-stopping-rounds", type=int, default=50)
+  parser.add_argument("--n-estimators", type=int, default=default_params["n_estimators"], help="maximum number of trees")
+  parser.add_argument("--learning-rate", type=float, default=default_params["learning_rate"])
+  args = parser.parse_args()
+
+  df, times = loadTrainingDataset(args.dataset)
+  params = {"n_estimators": args.n_estimators, "learning_rate": args.learning_rate}
+  models = trainModels(df, times, args.threads, params, args.valid_fraction, args.early_stopping_rounds)
+
+  version = args.version or getNextModelVersion()
+  path = saveModels(models, version)
+  for model in models:
+    print(json.dumps({key: value for key, value in model.items() if key != "regressor"}), flush=True)
+  print(f"Models written to {path}", flush=True)
@@ -1,3 +1,10 @@
 from .extract_transform import *
 from .charts import *
 from .inference import *
+from .feature_store import *
+from .parallel import *
+from .out_of_core import *
+from .ranking import *
+from .artifacts import *
+from .training import *
+from .simulation import *
@@ -0,0 +1,97 @@
+import threading
+from .extract_transform import *
+from .feature_store import loadFeatureStore
+
+
+def buildCompactFrames(clean_portfolio_df, clean_profiles):
+  """ Returns the id dtypes of the compact schema and the portfolio and profiles converted to it
+  """
+
+  profile_df = clean_profiles[1]
+  id_dtypes = createIdDtypes(clean_portfolio_df, profile_df)
+
+  return id_dtypes, cachedCompactFrame(clean_portfolio_df, id_dtypes), cachedCompactFrame(profile_df, id_dtypes)
+
+
+# Artifacts of the web app: name -> (names of the artifacts it is built from, function building it
+# from them). Frames are in the compact schema (dictionary encoded ids and narrow numeric types).
+artifact_builders = {
+  "clean_portfolio_df": ([], cachedLoadAndCleanPortfolio),
+  "clean_profiles": ([], lambda: cachedLoadAndCleanProfile(return_raw=True)),
+  "compact_frames": (["clean_portfolio_df", "clean_profiles"], buildCompactFrames),
+  "id_dtypes": (["compact_frames"], lambda frames: frames[0]),
+  "portfolio_df": (["compact_frames"], lambda frames: frames[1]),
+  "profile_df": (["compact_frames"], lambda frames: frames[2]),
+  "time_windows": (["portfolio_df"], lambda portfolio_df: sorted(24*portfolio_df["duration"].unique())),
+  "transcript_df": (["id_dtypes"], cachedLoadAndCleanTranscript),
+  # Demographic bins fitted once and saved with the models, so that the groups are stable between runs
+  "demographic_bins": (["clean_profiles"], lambda profiles: getDemographicBins(profiles[0])),
+  "demographics": (["clean_profiles", "demographic_bins"],
+                   lambda profiles, demographic_bins: cachedCreateDemographicGroups(profiles[0], demographic_bins)),
+  # Pre-aggregated chart inputs, so that the charts don't grow with the number of customers
+  "promo_funnel": (["transcript_df", "portfolio_df"], getPromoFunnel),
+  "offer_dist": (["transcript_df", "portfolio_df"], getOffersDist),
+  "demographic_dists": (["demographics"], cachedCreateDemographicDistributions),
+  # Features and targets with the updates of the feature store (see getFeaturesAndTargets), if any
+  "feature_store": ([], lambda: loadFeatureStore()),
+  "transcript_feats": (["feature_store", "transcript_df", "portfolio_df", "profile_df"],
+                       lambda store, *args: store[0] if store is not None else cachedCreateTranscriptFeatures(*args)),
+  "Y_df": (["feature_store", "transcript_feats", "portfolio_df"],
+           lambda store, *args: store[1] if store is not None else cachedCreateTargets(*args)),
+  "df_full": (["transcript_feats", "Y_df"],
+              lambda transcript_feats, Y_df: cachedGetTrainingDataset(transcript_feats, Y_df, return_df_full=True)[0]),
+  "demog_spendings": (["df_full", "demographics", "time_windows"],
+                      lambda *args: cachedCreateSpendingsPerGroup(*args, return_raw=True)),
+  "spendings_cube": (["demog_spendings", "demographics"],
+                     lambda demog_spendings, demographics: cachedCreateSpendingsCube(demog_spendings[0], demographics)),
+  "spendings_stats": (["demog_spendings"], lambda demog_spendings: cachedCreateSpendingsStats(demog_spendings[0])),
+  # Customers' rows sorted by person and their offsets index, for the person-scoped lookups
+  "indexed_transcript": (["transcript_df"], cachedCreatePersonIndex),
+  "indexed_feats": (["transcript_feats"], cachedCreatePersonIndex),
+}
+
+# Artifacts built in this process (shared by all sessions) and the lock of each artifact, held while
+# it is being built
+_artifacts = {}
+_artifact_locks = {name: threading.Lock() for name in artifact_builders}
+_warming_thread = None
+_warming_lock = threading.Lock()
+
+
+def getArtifact(name):
+  """ Returns an artifact of the web app, building it (and the artifacts it depends on) on first
+  access; threads requesting an artifact being built wait for it instead of building it again
+  """
+
+  if name in _artifacts:
+    return _artifacts[name]
+
+  dependencies, builder = artifact_builders[name]
+  inputs = [getArtifact(dependency) for dependency in dependencies]
+  with _artifact_locks[name]:
+    if name not in _artifacts:
+      _artifacts[name] = builder(*inputs)
+
+  return _artifacts[name]
+
+
+def getArtifacts(*names):
+  """ Returns a list with the artifacts of the names given
+  """
+
+  return [getArtifact(name) for name in names]
+
+
+def warmArtifacts(names=None):
+  """ Builds the artifacts (all of them by default) in a background thread, started once per process,
+  so that they are ready when a page requests them
+  """
+
+  global _warming_thread
+  with _warming_lock:
+    if _warming_thread is None:
+      names = list(artifact_builders) if names is None else names
+      _warming_thread = threading.Thread(target=getArtifacts, args=names, daemon=True)
+      _warming_thread.start()
+
+  return _warming_thread
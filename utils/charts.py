@@ -1,9 +1,13 @@
+import functools
+import threading
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 import plotly.express as px
 import plotly.io as pio
 import seaborn as sns
 import streamlit as st
+from .stage_cache import frameKey
 
 # Set the chart themes
 pio.templates.default = "none"
@@ -22,7 +26,39 @@ demog_group_cols = {
   "Gender": "gender"
 }
 
+# Figures rendered in this process (shared by all sessions), least recently used first
+figure_cache_size = 64
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
 
+
+def cachedFigure(chart_func):
+  """ Decorator caching the figures of a chart function, keyed by its data (the key of the dataframe,
+  see frameKey) and its other arguments (e.g. the feature selected)
+  """
+
+  @functools.wraps(chart_func)
+  def wrapper(df, *args):
+    key = (chart_func.__name__, frameKey(df), args)
+    with _figure_cache_lock:
+      if key in _figure_cache:
+        _figure_cache.move_to_end(key)
+        return _figure_cache[key]
+
+    fig = chart_func(df, *args)
+    with _figure_cache_lock:
+      _figure_cache[key] = fig
+      if len(_figure_cache) > figure_cache_size:
+        _, evicted_fig = _figure_cache.popitem(last=False)
+        if isinstance(evicted_fig, plt.Figure):
+          plt.close(evicted_fig)
+
+    return fig
+
+  return wrapper
+
+
+@cachedFigure
 def promoFunnelFig(promo_funnel):
   """ Returns a figure with the bar chart of the offer's marketing funnel
   """
@@ -33,6 +69,7 @@ def promoFunnelFig(promo_funnel):
   ])
 
 
+@cachedFigure
 def sentOffersDistributionFig(offer_dist):
   """ Returns a figure with the distribution of offer types sent
   """
@@ -49,11 +86,13 @@ def sentOffersDistributionFig(offer_dist):
   return fig
 
 
-def demographicDistributionBarH(df, feat):
-  """ Returns a figure with the value counts of a demographic feature in a horizontal bar chart
+@cachedFigure
+def demographicDistributionBarH(group_dists, feat):
+  """ Returns a figure with the share of customers in each group of a demographic feature in a
+  horizontal bar chart, given the group distributions of createDemographicDistributions
   """
 
-  group_dist = df[demog_group_cols[feat]].value_counts(normalize=True, sort=False)
+  group_dist = group_dists[group_dists["feature"]==demog_group_cols[feat]].set_index("group")["share"]
   fig, ax = plt.subplots(figsize=(5,2))
   group_dist.plot.barh(ax=ax)
   ax.set_xticklabels(["{:,.0%}".format(x) for x in ax.get_xticks()])
@@ -62,40 +101,54 @@ def demographicDistributionBarH(df, feat):
   return fig
 
 
-def demographicDistributionHist(df, feat):
-  """ Returns a figure with the histogram of a demographic feature
+@cachedFigure
+def demographicDistributionHist(hists, feat):
+  """ Returns a figure with the histogram of a demographic feature stacked by its groups, given the
+  counts per bin of createDemographicDistributions
   """
 
-  df_subset = df.dropna(subset=[demog_cols[feat]])
-  return px.histogram(df_subset, x=demog_cols[feat], color=demog_group_cols[feat])
+  hist = hists[hists["feature"]==demog_cols[feat]]
+  fig = go.Figure(data=[
+    go.Bar(
+      name=str(group),
+      x=(group_hist["bin_left"] + group_hist["bin_right"]) / 2,
+      y=group_hist["count"],
+      width=group_hist["bin_right"] - group_hist["bin_left"],
+    )
+    for group, group_hist in hist.groupby("group", sort=False)
+  ])
+  fig.update_layout(barmode="stack", bargap=0, xaxis_title=demog_cols[feat], yaxis_title="count",
+                    legend_title=demog_group_cols[feat])
+
+  return fig
 
 
-def spendingsPerDemographicsBar(df, feat):
-  """ Returns a figure with the spendings per group of the demographic feature
+@cachedFigure
+def spendingsPerDemographicsBar(spendings_stats, feat):
+  """ Returns a figure with the mean daily spendings (and their confidence intervals) per group of
+  the demographic feature, given the statistics of createSpendingsStats
   """
-  
+
+  stats = spendings_stats[spendings_stats["feature"]==feat]
   fig, ax = plt.subplots(figsize=(4, 2))
 
-  palette = "PuRd"
-  errcolor = "white"
+  colors = sns.color_palette("PuRd", stats.shape[0])
+  errors = [stats["mean"] - stats["ci_low"], stats["ci_high"] - stats["mean"]]
+  labels = stats["group"].astype(str)
+  positions = range(stats.shape[0])
 
   if feat != "offer_code":
-    sns.barplot(
-      x=feat,
-      y="daily_offer_spending",
-      data=df,
-      palette=palette,
-      ax=ax,
-      errcolor=errcolor
-    )
+    ax.bar(positions, stats["mean"], yerr=errors, color=colors, ecolor="white")
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels)
+    ax.set_xlabel(feat)
+    ax.set_ylabel("daily_offer_spending")
   else:
-    sns.barplot(
-      x="daily_offer_spending",
-      y=feat,
-      data=df,
-      palette=palette,
-      ax=ax,
-      errcolor=errcolor
-    )
+    ax.barh(positions, stats["mean"], xerr=errors, color=colors, ecolor="white")
+    ax.set_yticks(positions)
+    ax.set_yticklabels(labels)
+    ax.invert_yaxis()
+    ax.set_xlabel("daily_offer_spending")
+    ax.set_ylabel(feat)
 
   return fig
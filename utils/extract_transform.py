@@ -1,19 +1,44 @@
-import streamlit as st
+import itertools
+import json
+import os
+from statistics import NormalDist
 import pandas as pd
 import numpy as np
 import warnings
+from .stage_cache import runStage
+from .profiling import instrument
 warnings.filterwarnings("ignore", category=FutureWarning)
 
+# Types of the transcript events (dictionary encoded in the compact schema)
+event_types = ["offer completed", "offer received", "offer viewed", "transaction"]
 
-@st.cache
+# Columns accumulated by the features: original column (or event dummy) name: cumulative column name
+agg_cols = {
+  "amount": "cum_spending",
+  "reward": "cum_reward",
+  "transaction": "transactions",
+  "offer received": "offers_received",
+  "offer viewed": "offers_viewed",
+  "offer completed": "offers_completed",
+}
+
+# Confidence level of the intervals of the spending medians
+median_ci_level = 0.95
+
+# File of the demographic bins fitted on the profiles (kept with the models)
+demographic_bins_path = "models/demographic_bins.json"
+
+
+@instrument
 def cachedLoadAndCleanPortfolio():
-  return loadAndCleanPortfolio()
+  return runStage("portfolio_df", loadAndCleanPortfolio, files=["data/portfolio.json"])
 
-def loadAndCleanPortfolio():
+@instrument
+def loadAndCleanPortfolio(path="data/portfolio.json"):
   """ Load and clean portfolio data
   """
 
-  portfolio = pd.read_json('data/portfolio.json', orient='records', lines=True)
+  portfolio = pd.read_json(path, orient='records', lines=True)
   
   # Available channels
   channels = ["email", "mobile", "social", "web"]
@@ -40,15 +65,16 @@ def loadAndCleanPortfolio():
   return portfolio_df
 
 
-@st.cache
+@instrument
 def cachedLoadAndCleanProfile(return_raw=False):
-  return loadAndCleanProfile(return_raw)
+  return runStage("profile_df", loadAndCleanProfile, files=["data/profile.json"], params={"return_raw": return_raw})
 
-def loadAndCleanProfile(return_raw=False):
+@instrument
+def loadAndCleanProfile(return_raw=False, path="data/profile.json"):
   """ Load and clean profile data
   """
 
-  profile = pd.read_json('data/profile.json', orient='records', lines=True)
+  profile = pd.read_json(path, orient='records', lines=True)
 
   profile_df = profile.copy()
 
@@ -66,57 +92,153 @@ def loadAndCleanProfile(return_raw=False):
     return profile_df
 
 
-@st.cache
-def cachedLoadAndCleanTranscript():
-  return loadAndCleanTranscript()
+@instrument
+def cachedLoadAndCleanTranscript(id_dtypes=None):
+  params = {"id_dtypes": id_dtypes} if id_dtypes is not None else None
+  return runStage("transcript_df", loadAndCleanTranscript, files=["data/transcript.json"], params=params)
 
-def loadAndCleanTranscript():
+@instrument
+def loadAndCleanTranscript(path="data/transcript.json", chunksize=100000, id_dtypes=None):
   """ Load and clean transcript data
+
+  The file is read in chunks of json lines, so that only one chunk of raw value dicts is held
+  in memory at a time. If the dtypes of the ids are given (see createIdDtypes), each chunk is
+  converted to the compact schema.
   """
 
-  transcript = pd.read_json('data/transcript.json', orient='records', lines=True)
+  reader = pd.read_json(path, orient='records', lines=True, chunksize=chunksize)
+  chunks = [parseTranscriptRecords(chunk) for chunk in reader]
+  if id_dtypes is not None:
+    chunks = [compactFrame(chunk, id_dtypes) for chunk in chunks]
+  transcript_df = pd.concat(chunks, ignore_index=True)
+
+  return sortAndNumberEvents(transcript_df)
 
-  transcript_temp = transcript.copy()
+
+@instrument
+def sortAndNumberEvents(transcript_df):
+  """ Returns the parsed transcript records sorted by person and time (keeping the order of the
+  records at the same time) with the event number per person
+  """
 
   # Create event number per person
-  transcript_temp = transcript_temp.sort_values(["person", "time"])
-  transcript_temp["event_no"] = transcript_temp.groupby("person").cumcount() + 1
+  transcript_df = transcript_df.sort_values(["person", "time"], kind="mergesort").reset_index(drop=True)
+  event_no = transcript_df.groupby("person", observed=True).cumcount() + 1
+  if getIdDtypes(transcript_df) is not None:
+    event_no = event_no.astype(np.int32)
+  transcript_df.insert(1, "event_no", event_no)
 
-  # Explode value column to a list of key-values pairs
-  transcript_temp["aux"] = transcript_temp["value"].apply(lambda d: d.items())
-  transcript_temp = transcript_temp.explode("aux")
+  return transcript_df
 
-  # Extract key and value for each exploded row
-  transcript_temp["k"] = transcript_temp["aux"].str[0]
-  transcript_temp["v"] = transcript_temp["aux"].str[1]
 
-  # Pivot
-  transcript_df = transcript_temp.pivot(
-      index=["person", "event_no", "event", "time"],
-      columns="k",
-      values="v"
-    )
+@instrument
+def parseTranscriptRecords(transcript):
+  """ Returns a dataframe with the value dict of the raw transcript records flattened into
+  the offer_id, amount and reward columns
+  """
 
-  # Reset index
-  transcript_df = transcript_df.reset_index()
-  transcript_df.columns.name = None
+  values = transcript["value"].to_numpy()
+  n_events = len(values)
 
-  # Clean up values
-  transcript_df["offer_id"] = transcript_df["offer_id"].combine_first(transcript_df["offer id"])
-  transcript_df = transcript_df.drop(columns="offer id")
-  transcript_df["amount"] = pd.to_numeric(transcript_df["amount"])
+  # Offers received and viewed are keyed by "offer id" while completed offers use "offer_id"
+  offer_id = np.array([v.get("offer_id", v.get("offer id")) for v in values], dtype=object)
+  # Fill amount and reward with 0 when missing for ease of manipulation
+  amount = np.fromiter((v.get("amount", 0) for v in values), dtype=np.float64, count=n_events)
+  reward = np.fromiter((v.get("reward", 0) for v in values), dtype=np.int64, count=n_events)
 
-  # Fill amount and reward with 0 when nan for ease of manipulation
-  transcript_df["amount"] = transcript_df["amount"].fillna(0)
-  transcript_df["reward"] = transcript_df["reward"].fillna(0)
+  return pd.DataFrame({
+    "person": transcript["person"].to_numpy(),
+    "event": transcript["event"].to_numpy(),
+    "time": transcript["time"].to_numpy(),
+    "amount": amount,
+    "offer_id": offer_id,
+    "reward": reward,
+  })
 
-  return transcript_df
+
+@instrument
+def createIdDtypes(portfolio_df, profile_df):
+  """ Returns the categorical dtypes of the person, offer_id, offer_code and event columns in the
+  compact schema
+
+  The categories are sorted (so codes sort as the ids) and are the lookup tables from the codes back
+  to the hex ids: code i of a column stands for its dtype's categories[i]
+  """
+
+  return {
+    "person": pd.CategoricalDtype(np.sort(profile_df["person"].astype(str).unique())),
+    "offer_id": pd.CategoricalDtype(np.sort(portfolio_df["offer_id"].astype(str).unique())),
+    "offer_code": pd.CategoricalDtype(np.sort(portfolio_df["code"].astype(str).unique())),
+    "event": pd.CategoricalDtype(event_types),
+  }
+
+
+@instrument
+def getIdDtypes(df):
+  """ Returns the categorical dtypes of the id columns of a dataframe in the compact schema, or None if
+  it isn't in the compact schema (person not dictionary encoded)
+  """
+
+  if "person" not in df or not isinstance(df["person"].dtype, pd.CategoricalDtype):
+    return None
+
+  return {col: df[col].dtype for col in ["person", "offer_id", "offer_code", "event"]
+          if col in df and isinstance(df[col].dtype, pd.CategoricalDtype)}
 
 
+@instrument
+def compactFrame(df, id_dtypes):
+  """ Returns the dataframe in the compact schema: ids dictionary encoded with the given categorical
+  dtypes, 0/1 flags as uint8, other integers as int32 (when they fit) and floats as float32
+  """
+
+  int32_info = np.iinfo(np.int32)
+
+  compact_cols = {}
+  for col in df.columns:
+    values = df[col]
+    if col in id_dtypes:
+      compact_values = values.astype(id_dtypes[col])
+      if (compact_values.isna() & values.notna()).any():
+        raise ValueError(f"Values of {col} not found in the ids of the compact schema")
+    elif pd.api.types.is_integer_dtype(values.dtype) and len(values) > 0:
+      min_value, max_value = values.min(), values.max()
+      if min_value >= 0 and max_value <= 1:
+        compact_values = values.astype(np.uint8)
+      elif min_value >= int32_info.min and max_value <= int32_info.max:
+        compact_values = values.astype(np.int32)
+      else:
+        compact_values = values
+    elif pd.api.types.is_float_dtype(values.dtype):
+      compact_values = values.astype(np.float32)
+    else:
+      compact_values = values
+    compact_cols[col] = compact_values
+
+  return pd.DataFrame(compact_cols, index=df.index)
+
+
+@instrument
+def cachedCompactFrame(df, id_dtypes):
+  return runStage("compact_frame", compactFrame, args=(df,), params={"id_dtypes": id_dtypes}, persist=False)
+
+
+@instrument
+def getCodes(values):
+  """ Returns the codes of a dictionary encoded series (or the values of other series) as an array to
+  group or sort by
+  """
+
+  if isinstance(values.dtype, pd.CategoricalDtype):
+    return values.cat.codes.to_numpy()
+  return values.to_numpy()
+
+
+@instrument
 def getPromoFunnel(transcript_df, portfolio_df):
   """Get a dataframe containing funnel data of offers"""
   # Effectiveness of each channel in converting with promotion
-  promo_funnel = transcript_df.groupby(["offer_id", "event"]).size().unstack()
+  promo_funnel = transcript_df.groupby(["offer_id", "event"], observed=True).size().unstack().sort_index(axis=1)
   promo_funnel = promo_funnel.fillna(0).astype(int)
   promo_funnel["view_rate"] = promo_funnel["offer viewed"] / promo_funnel["offer received"]
   promo_funnel["comp_rate"] = promo_funnel["offer completed"] / promo_funnel["offer viewed"]
@@ -128,10 +250,11 @@ def getPromoFunnel(transcript_df, portfolio_df):
   )
 
 
+@instrument
 def getOffersDist(transcript_df, portfolio_df):
   """Get a dataframe containing the distribution of offers received"""
   received_offers = transcript_df[transcript_df["event"]=="offer received"]
-  offers_dist = transcript_df.groupby("offer_id", as_index=False).size()
+  offers_dist = transcript_df.groupby("offer_id", as_index=False, observed=True).size()
   offers_dist["size"] /= offers_dist["size"].sum()
   offers_dist["size"] -= 1/offers_dist.shape[0]
   offers_dist = offers_dist.merge(portfolio_df, on="offer_id")
@@ -140,50 +263,39 @@ def getOffersDist(transcript_df, portfolio_df):
   return offers_dist
 
 
-@st.cache
+@instrument
 def cachedCreateTranscriptFeatures(transcript_df, portfolio_df, profile_df):
-  return createTranscriptFeatures(transcript_df, portfolio_df, profile_df)
+  return runStage("transcript_feats", createTranscriptFeatures, args=(transcript_df, portfolio_df, profile_df))
 
+@instrument
 def createTranscriptFeatures(transcript_df, portfolio_df, profile_df):
   """ Returns dataframe containing useful features for predicting customer behaviour
+
+  If the transcript is in the compact schema, so are the features
   """
 
   transcript_feats = transcript_df.copy()
 
-  # Create dummy variables for the events (to perform a cumulative sum)
-  transcript_feats = pd.concat([transcript_feats, pd.get_dummies(transcript_feats["event"])], axis=1)
-  transcript_feats["event_no_aux"] = 1
-
-  # Define the columns to aggregate, their function and their new name
-  agg_cols = {
-      # original column name: (agg function, agg column name)
-      "event_no_aux": ("sum", "event_no"),
-      "amount": ("sum", "cum_spending"),
-      "reward": ("sum", "cum_reward"),
-      "transaction": ("sum", "transactions"),
-      "offer received": ("sum", "offers_received"),
-      "offer viewed": ("sum", "offers_viewed"),
-      "offer completed": ("sum", "offers_completed"),
-      "time": ("min", "min_time")
-  }
-  aggs = {k: v[0] for k, v in agg_cols.items()}
-  rename = {k:v[1] for k,v in agg_cols.items()}
-
-  # Perform the aggregations on the expanding window partitioned by each person
-  transcript_aggs = transcript_feats.groupby("person").expanding().agg(aggs)
-  transcript_aggs = transcript_aggs.rename(columns=rename)
-  transcript_aggs = transcript_aggs.reset_index().drop(columns="level_1")
-  transcript_feats = transcript_feats.drop(columns="event_no_aux")
-  transcript_feats = transcript_feats.merge(transcript_aggs, on=["person", "event_no"])
+  events = ["offer received", "offer viewed", "transaction", "offer completed"]
 
-  # Subtract the current "event" so that they account only for the past (without information not available on inference time)
-  cols_subtract = [col for col in agg_cols.keys() if col not in ["event_no_aux", "time"]]
-  cols_keep = [rename[col] for col in cols_subtract]
-  transcript_feats.loc[:, cols_keep] -= transcript_feats.loc[:, cols_subtract].values
+  # Values of each event to accumulate (event dummies are used to count the events)
+  event_values = pd.DataFrame({
+      col: transcript_feats[col].to_numpy(dtype=np.float64) if col not in events
+           else (transcript_feats["event"]==col).to_numpy(dtype=np.float64)
+      for col in agg_cols
+    }, index=transcript_feats.index)
+
+  # Perform the cumulative sums partitioned by each person in a single pass over the rows and
+  # subtract the current "event" so that they account only for the past (without information
+  # not available on inference time)
+  per_person = getCodes(transcript_feats["person"])
+  cum_values = event_values.groupby(per_person, sort=False).cumsum() - event_values
+  for col, cum_col in agg_cols.items():
+    transcript_feats[cum_col] = cum_values[col]
 
   # Time since each person's first event
-  transcript_feats["time_since_first_event"] = transcript_feats["time"] - transcript_feats["min_time"]
-  transcript_feats = transcript_feats.drop(columns="min_time")
+  min_time = transcript_feats["time"].groupby(per_person, sort=False).cummin()
+  transcript_feats["time_since_first_event"] = (transcript_feats["time"] - min_time).astype(np.float64)
 
   # Average transaction value (up to that point)
   transcript_feats["atv"] = transcript_feats["cum_spending"] / transcript_feats["transactions"]
@@ -191,11 +303,9 @@ def createTranscriptFeatures(transcript_df, portfolio_df, profile_df):
   transcript_feats["offer_usage"] = transcript_feats["offers_completed"] / transcript_feats["offers_received"]
 
   # Time since last transaction, offer received, offer viewed, and offer completed
-  events = ["offer received", "offer viewed", "transaction", "offer completed"]
-  transcript_feats = transcript_feats.drop(columns=events)
   for event in events:
       # Define auxiliary variables
-      event_count = rename[event]
+      event_count = agg_cols[event]
       event_name = event.replace(' ','_')
       cols_aux = ["person", event_count, "time"]
       col_last_event_at = f"last_{event_name}_at"
@@ -215,89 +325,157 @@ def createTranscriptFeatures(transcript_df, portfolio_df, profile_df):
   # Change offer duration to hours and create time until offers are valid
   transcript_feats["offer_duration"] = 24*transcript_feats["offer_duration"]
 
-  # Add customer offer timeline
-  # 1. Select only relevant rows and columns
-  received_offers = transcript_feats[transcript_feats["event"]=="offer received"]
-  received_offers = received_offers[["person","event_no","time","event","offer_code","offer_duration"]]
-  offer_dummies = pd.get_dummies(received_offers["offer_code"], prefix="active")
-  received_offers = pd.concat([received_offers, offer_dummies], axis=1)
-  # 2. Repeat rows of offers by their time duration in hours
-  rep_index = received_offers.index.repeat(received_offers["offer_duration"])
-  active_offers = received_offers.drop(columns=["event","offer_code","offer_duration"]).loc[rep_index]
-  active_offers["time"] += active_offers.groupby(["person","event_no"]).cumcount()
-  # 3. Aggregate the offers by person and time, taking all the valid offers at that time and join
-  active_offers = active_offers.drop(columns="event_no").groupby(["person","time"], as_index=False).max()
-  transcript_feats = transcript_feats.merge(active_offers, on=["person","time"], how="left")
-  # 4. Fill NA and convert value of active offer columns (if it's na, customer didn\t receive it)
-  offer_cols = [f"active_{offer}" for offer in portfolio_df["code"]]
-  transcript_feats[offer_cols] = transcript_feats[offer_cols].fillna(0).astype(int)
+  # Add customer offer timeline (flags of the offers received that are still valid at each event)
+  offer_codes = sorted(portfolio_df["code"])
+  active_offers = getActiveOffers(transcript_feats, offer_codes)
+  transcript_feats = pd.concat([transcript_feats, active_offers], axis=1)
 
   # Transform remaining offer data
-  offer_type_dummies = pd.get_dummies(transcript_feats["offer_type"], prefix="offer_type")
+  offer_types = pd.Categorical(transcript_feats["offer_type"], categories=sorted(portfolio_df["type"].unique()))
+  offer_type_dummies = pd.get_dummies(offer_types, prefix="offer_type").set_index(transcript_feats.index)
   transcript_feats = pd.concat([transcript_feats.drop(columns="offer_type"), offer_type_dummies], axis=1)
 
   # Add demografic data
   transcript_feats = transcript_feats.merge(profile_df, on="person", how="left")
 
+  id_dtypes = getIdDtypes(transcript_df)
+  if id_dtypes is not None:
+    id_dtypes["offer_code"] = pd.CategoricalDtype(np.sort(portfolio_df["code"].astype(str).unique()))
+    transcript_feats = compactFrame(transcript_feats, id_dtypes)
+
   return transcript_feats
 
 
-@st.cache
+@instrument
+def getActiveOffers(transcript_feats, offer_codes):
+  """ Returns a dataframe with an active_<code> column for each offer code flagging if the customer
+  received that offer and it was still valid at the time of the event
+  """
+
+  # Sort key of each event by person and then time
+  person, _ = pd.factorize(transcript_feats["person"])
+  time = transcript_feats["time"].to_numpy(dtype=np.int64)
+  time_span = time.max() - time.min() + 1
+  event_key = person * time_span + (time - time.min())
+
+  received = (transcript_feats["event"]=="offer received").to_numpy()
+  offer_code = transcript_feats["offer_code"].to_numpy()
+  valid_until = (transcript_feats["time"] + transcript_feats["offer_duration"]).to_numpy()
+
+  active_offers = {}
+  for code in offer_codes:
+    # Validity intervals [time, time+duration) of the offers received, sorted by person and start
+    offer_rows = np.flatnonzero(received & (offer_code==code))
+    if len(offer_rows) == 0:
+      active_offers[f"active_{code}"] = np.zeros(len(time), dtype=int)
+      continue
+    offer_rows = offer_rows[np.argsort(event_key[offer_rows], kind="stable")]
+    offer_person = person[offer_rows]
+    offer_start = event_key[offer_rows]
+    # Latest end among the offers received by the person up to each interval
+    offer_end = pd.Series(valid_until[offer_rows]).groupby(offer_person).cummax().to_numpy()
+
+    # For each event, find the last offer received by the same person at or before the event
+    last_offer = np.searchsorted(offer_start, event_key, side="right") - 1
+    has_offer = last_offer >= 0
+    last_offer = np.where(has_offer, last_offer, 0)
+    is_active = has_offer & (offer_person[last_offer]==person) & (offer_end[last_offer] > time)
+
+    active_offers[f"active_{code}"] = is_active.astype(int)
+
+  return pd.DataFrame(active_offers, index=transcript_feats.index)
+
+
+@instrument
 def cachedCreateTargets(transcript_feats, portfolio_df):
-  return createTargets(transcript_feats, portfolio_df)
+  return runStage("Y_df", createTargets, args=(transcript_feats, portfolio_df))
 
+@instrument
 def createTargets(transcript_feats, portfolio_df):
   """Returns a dataframe containing the spendings for every time window of offer durations"""
 
   # Auxiliary variables
-  dummy_base_ts = pd.Timestamp("2021-01-01")
-  last_event_ts = dummy_base_ts + pd.to_timedelta(transcript_feats["time"].max(), "h")
+  last_event_time = transcript_feats["time"].max()
   time_windows = sorted(24*portfolio_df["duration"].unique())
 
   # Filter only relevant columns and rows
-  target_df = transcript_feats[["person","time","event","amount"]].copy()
-  target_df = target_df[target_df["event"].isin(["offer received", "transaction"])]
-  Y_df = target_df.copy()
-
-  # Add dummy events in the future (to make sure it exists an event at time t+time_window
-  # for every event occurring at time t) - this is done because rolling is only performed
-  # for previous rows
-  dummy_events = target_df.copy().rename(columns={"time": "orig_time"})
-  dummy_events["amount"] = 0
-  for time_window in time_windows:
-      dummy_events["time"] = dummy_events["orig_time"] + time_window
-      target_df = pd.concat([target_df, dummy_events.drop(columns="orig_time")])
-
-  # Group concurrent events
-  # A dummy base timestamp is used because it's needed in the following rolling function
-  target_df["ts"] = dummy_base_ts + pd.to_timedelta(target_df["time"], "h")
-  target_df = target_df.drop(columns="time")
-  target_df = target_df.groupby(["person","ts"], as_index=False).sum()
+  target_df, Y_df = getTargetEvents(transcript_feats)
 
   # Calculate the future spending for each time window (offer durations)
-  for time_window in time_windows:
-      # Rolling sums (closed on the left endpoint so that transactions occurring at the same time, i.e. hour,
-      # are included in the future spending)
-      rs = target_df.groupby("person", as_index=False).rolling(f"{time_window}h", on="ts", closed="left").sum()
-      rs_spending_col_name = f"spending_next_{time_window}h"
-      rs = rs.rename(columns={"amount": rs_spending_col_name})
+  spendings = getFutureSpendings(target_df, Y_df, time_windows, last_event_time)
 
-      # Set spendings to NA if time window contains events after the last time in the dataset
-      rs[rs_spending_col_name] = rs[rs_spending_col_name].where(rs["ts"] < last_event_ts)
+  return setTargets(Y_df, spendings, time_windows, transcript_feats)
+
+
+@instrument
+def getTargetEvents(transcript_feats):
+  """ Returns the events needed to calculate the targets (offers received and transactions) and
+  the offers received, whose targets are calculated
+  """
+
+  target_df = transcript_feats[["person","time","event","amount"]]
+  target_df = target_df[target_df["event"].isin(["offer received", "transaction"])].reset_index(drop=True)
+  Y_df = target_df[target_df["event"]=="offer received"][["person","time"]].copy()
+
+  return target_df, Y_df
 
-      # Shifts events by the time_window so that the rolling sum is over the future
-      rs["time"] = (rs["ts"]-dummy_base_ts).dt.total_seconds()/3600 - time_window
-      rs["time"] = rs["time"].astype(int)
-      rs = rs.drop(columns="ts")
 
-      Y_df = Y_df.merge(rs, on=["person","time"], how="left")
+@instrument
+def setTargets(Y_df, spendings, time_windows, transcript_feats):
+  """ Returns Y_df with a target column for each time window from the spendings array (queries x
+  time windows), in the schema of the features
+  """
+
+  for i, time_window in enumerate(time_windows):
+      Y_df[f"spending_next_{time_window}h"] = spendings[:, i]
 
-  Y_df = Y_df[Y_df["event"]=="offer received"]
-  Y_df = Y_df.drop(columns=["event","amount"])
+  id_dtypes = getIdDtypes(transcript_feats)
+  if id_dtypes is not None:
+    Y_df = compactFrame(Y_df, id_dtypes)
 
   return Y_df
 
 
+@instrument
+def getFutureSpendings(events, queries, time_windows, last_event_time):
+  """ Returns an array (queries x time windows) with the amount spent by each query's person in
+  the time window starting at the query's time
+  """
+
+  # Sort key of events and queries by person and then time (the span fits any time plus window)
+  person, _ = pd.factorize(getCodes(pd.concat([events["person"], queries["person"]], ignore_index=True)))
+  event_person, query_person = person[:len(events)], person[len(events):]
+  event_time = events["time"].to_numpy(dtype=np.int64)
+  query_time = queries["time"].to_numpy(dtype=np.int64)
+  min_time = min(event_time.min(initial=0), query_time.min(initial=0))
+  time_span = max(event_time.max(initial=0), query_time.max(initial=0)) - min_time + max(time_windows) + 1
+  event_key = event_person * time_span + (event_time - min_time)
+  query_key = query_person * time_span + (query_time - min_time)
+
+  order = np.argsort(event_key, kind="stable")
+  event_key = event_key[order]
+  amount = events["amount"].to_numpy(dtype=np.float64)[order]
+
+  # Cumulative amount spent per person, including (and excluding) each event
+  cum_amount = pd.Series(amount).groupby(event_person[order]).cumsum().to_numpy()
+  prev_cum_amount = cum_amount - amount
+
+  # Spending in [time, time+window) is the difference between cumulative amounts at the window ends
+  # (transactions occurring at the same time, i.e. hour, are included in the future spending)
+  start = np.searchsorted(event_key, query_key, side="left")
+  spendings = np.zeros((len(query_key), len(time_windows)), dtype=np.float64)
+  for i, time_window in enumerate(time_windows):
+      end = np.searchsorted(event_key, query_key + time_window, side="left")
+      non_empty = end > start
+      spendings[non_empty, i] = cum_amount[end[non_empty]-1] - prev_cum_amount[start[non_empty]]
+
+      # Set spendings to NA if time window contains events after the last time in the dataset
+      spendings[query_time + time_window >= last_event_time, i] = np.nan
+
+  return spendings
+
+
+@instrument
 def dropAuxFeatures(df):
   """ Returns a copy of the dataframe with auxiliary columns not used for inferece dropped
   """
@@ -307,6 +485,12 @@ def dropAuxFeatures(df):
     ).copy()
 
 
+@instrument
+def cachedGetTrainingDataset(transcript_feats, Y_df, return_df_full=False):
+  params = {"return_df_full": return_df_full}
+  return runStage("df_full", getTrainingDataset, args=(transcript_feats, Y_df), params=params)
+
+@instrument
 def getTrainingDataset(transcript_feats, Y_df, return_df_full=False):
   """Returns the training dataset by joining the features and target and filtering
   for received offer events
@@ -322,28 +506,146 @@ def getTrainingDataset(transcript_feats, Y_df, return_df_full=False):
     return df
 
 
-def createDemographicGroups(profile):
-  """ Returns a dataframe containing the demographic groups defined
-  """
+@instrument
+def fitDemographicBins(profile):
+  """ Returns the bins of the demographic groups fitted on the raw profiles: for each group column,
+  the column binned, the bin edges and the group labels
 
-  demographics = profile.copy()
+  The age groups are fixed ranges, the income groups split the 20% lowest and highest incomes and the
+  cohorts are split where the number of new members jumps.
+  """
 
-  # Age groups
-  demographics["age_group"] = pd.cut(demographics["age"], [0,30,50,70,100,200], labels=np.arange(5)+1)
-  # Income groups
-  demographics["income_group"] = pd.qcut(demographics["income"], [0,.2,.8,1], labels=[0,1,2])
-  # Cohort groups
-  demographics["became_member_on"] = pd.to_datetime(demographics["became_member_on"].astype(str)).astype(int)
-  bins = demographics["became_member_on"].value_counts(bins=100, sort=False).to_frame()
+  # Income quantiles
+  _, income_edges = pd.qcut(profile["income"], [0,.2,.8,1], retbins=True)
+  # Cohort breaks
+  became_member_on = pd.to_datetime(profile["became_member_on"].astype(str)).astype(int)
+  bins = became_member_on.value_counts(bins=100, sort=False).to_frame()
   bins.columns = ["count"]
   bins["dcount"] = bins["count"].shift(1) - bins["count"]
   breaks = bins[abs(bins["dcount"])>100]
-  cohort_breaks = [0] + list(breaks.index.left) + list([demographics["became_member_on"].max()])
-  demographics["cohort_group"] = pd.cut(demographics["became_member_on"], cohort_breaks, labels=[1,2,3,4])
+  cohort_breaks = [0] + list(breaks.index.left) + list([became_member_on.max()])
+  if len(cohort_breaks) != 5:
+    raise ValueError(f"Found {len(cohort_breaks)-1} cohorts instead of 4")
+
+  return {
+    "age_group": {"col": "age", "edges": [0,30,50,70,100,200], "labels": [1,2,3,4,5]},
+    "income_group": {"col": "income", "edges": [float(e) for e in income_edges], "labels": [0,1,2]},
+    "cohort_group": {"col": "became_member_on", "edges": [float(e) for e in cohort_breaks], "labels": [1,2,3,4]},
+  }
+
+
+@instrument
+def saveDemographicBins(demographic_bins, path=demographic_bins_path):
+  """ Writes the fitted demographic bins to a json file
+  """
+
+  with open(path, "w") as handle:
+    json.dump(demographic_bins, handle, indent=2)
+
+
+@instrument
+def loadDemographicBins(path=demographic_bins_path):
+  """ Reads the demographic bins written by saveDemographicBins
+  """
+
+  with open(path) as handle:
+    return json.load(handle)
+
+
+@instrument
+def getDemographicBins(profile, path=demographic_bins_path):
+  """ Returns the saved demographic bins, fitting them on the profiles and saving them if there are
+  none yet (so that the groups are stable between runs, even if the profiles change)
+  """
+
+  if os.path.exists(path):
+    return loadDemographicBins(path)
+
+  demographic_bins = fitDemographicBins(profile)
+  saveDemographicBins(demographic_bins, path)
+
+  return demographic_bins
+
+
+@instrument
+def assignDemographicGroup(values, group_bins):
+  """ Returns the group of each value (categorical of the labels of the bins), by a binary search in
+  the right closed bins (values out of the edges are in the first or last group)
+  """
+
+  values = np.asarray(values, dtype=np.float64)
+  codes = np.searchsorted(np.asarray(group_bins["edges"][1:-1], dtype=np.float64), values, side="left")
+  codes = np.where(np.isnan(values), -1, codes)
+
+  return pd.Categorical.from_codes(codes, categories=group_bins["labels"], ordered=True)
+
+
+@instrument
+def cachedCreateDemographicGroups(profile, demographic_bins=None):
+  params = {"demographic_bins": demographic_bins}
+  return runStage("demographics", createDemographicGroups, args=(profile,), params=params)
+
+@instrument
+def createDemographicGroups(profile, demographic_bins=None):
+  """ Returns a dataframe containing the demographic groups defined
+
+  The groups are assigned with the given demographic bins (see fitDemographicBins), or with bins
+  fitted on the profiles if not given, so new customers can be grouped on their own
+  """
+
+  if demographic_bins is None:
+    demographic_bins = fitDemographicBins(profile)
+
+  demographics = profile.copy()
+  demographics["became_member_on"] = pd.to_datetime(demographics["became_member_on"].astype(str)).astype(int)
+  for group_col, group_bins in demographic_bins.items():
+    demographics[group_col] = assignDemographicGroup(demographics[group_bins["col"]], group_bins)
 
   return demographics
 
 
+@instrument
+def cachedCreateDemographicDistributions(demographics, n_bins=50):
+  return runStage("demographic_dists", createDemographicDistributions, args=(demographics,),
+                  params={"n_bins": n_bins}, persist=False)
+
+@instrument
+def createDemographicDistributions(demographics, n_bins=50):
+  """ Returns two dataframes for charting the distributions of the demographic features without
+  their rows: the share of customers in each group and the count of customers of each group per bin
+  of the features' values (n_bins equal width bins)
+  """
+
+  group_cols = {"age": "age_group", "income": "income_group", "became_member_on": "cohort_group"}
+
+  group_dists = []
+  for group_col in list(group_cols.values()) + ["gender"]:
+    group_dist = demographics[group_col].value_counts(normalize=True, sort=False).rename("share")
+    group_dist = group_dist.rename_axis("group").reset_index()
+    group_dist.insert(0, "feature", group_col)
+    group_dists.append(group_dist)
+
+  hists = []
+  for col, group_col in group_cols.items():
+    valid = demographics.dropna(subset=[col])
+    edges = np.histogram_bin_edges(valid[col], bins=n_bins)
+    bins = np.clip(np.searchsorted(edges, valid[col], side="right") - 1, 0, n_bins - 1)
+    hist = valid.groupby([valid[group_col], bins], observed=True).size().rename("count")
+    hist = hist.rename_axis(["group", "bin"]).reset_index()
+    hist["bin_left"] = edges[hist["bin"]]
+    hist["bin_right"] = edges[hist["bin"] + 1]
+    hist.insert(0, "feature", col)
+    hists.append(hist.drop(columns="bin"))
+
+  return pd.concat(group_dists, ignore_index=True), pd.concat(hists, ignore_index=True)
+
+
+@instrument
+def cachedCreateSpendingsPerGroup(df_full, demographics, time_windows, return_raw=False):
+  params = {"time_windows": [int(t) for t in time_windows], "return_raw": return_raw}
+  return runStage("demog_spendings", createSpendingsPerGroup, args=(df_full, demographics), params=params)
+
+@instrument
 def createSpendingsPerGroup(df_full, demographics, time_windows, return_raw=False):
   """ Returns a dataframe containing the customer spendings upon receiving an offer
   up until its validity grouped by each demographic group
@@ -371,10 +673,7 @@ def createSpendingsPerGroup(df_full, demographics, time_windows, return_raw=Fals
   demog_spendings = demog_spendings.dropna(subset=[target_col])
 
   # Get aggregate spendings by demographic groups and offers (median to filter outliers)
-  agg_metrics = {target_col: ["median","size"]}
-  metric_names = ["spending_median", "size"]
-  spendings_per_groups = demog_spendings.groupby(feat_cols).agg(agg_metrics).reset_index()
-  spendings_per_groups.columns = feat_cols + metric_names
+  spendings_per_groups = aggregateSpendings(demog_spendings, feat_cols).reset_index()
 
   # Drop groups with small sample size
   spendings_per_groups = spendings_per_groups[spendings_per_groups["size"] >= 30]
@@ -385,14 +684,201 @@ def createSpendingsPerGroup(df_full, demographics, time_windows, return_raw=Fals
     return spendings_per_groups
 
 
-def spendingsForOffers(df, offers, demog_feats, min_group_size):
-  """Returns a dataframe containing the spendings filtered by offers and grouped by demographic groups"""
+@instrument
+def getMedianConfidenceIntervals(values, groups, n_groups, level=median_ci_level):
+  """ Returns the lower and upper bounds of the distribution free confidence intervals of the median
+  of each group (numbered 0 to n_groups-1) of the values, at the given level
+
+  The bounds are order statistics of each group, at the ranks around the middle one where the
+  binomial(n, 1/2) count of values below the median is within its normal approximation interval, so
+  all groups are done with a single sort instead of resampling them.
+  """
+
+  order = np.lexsort((values, groups))
+  sorted_values = np.asarray(values)[order]
+  sizes = np.bincount(groups, minlength=n_groups)
+  starts = np.cumsum(sizes) - sizes
+
+  # 1-based ranks of the bounds in each group (the whole range of the values for small groups)
+  half_width = NormalDist().inv_cdf((1 + level) / 2) * np.sqrt(sizes) / 2
+  low_rank = np.clip(np.floor(sizes/2 - half_width), 1, np.maximum(sizes, 1)).astype(np.int64)
+  high_rank = np.clip(np.ceil(sizes/2 + half_width + 1), 1, np.maximum(sizes, 1)).astype(np.int64)
+
+  ci_low = np.where(sizes > 0, sorted_values[np.minimum(starts + low_rank - 1, len(values) - 1)], np.nan)
+  ci_high = np.where(sizes > 0, sorted_values[np.minimum(starts + high_rank - 1, len(values) - 1)], np.nan)
+
+  return ci_low, ci_high
+
+
+@instrument
+def aggregateSpendings(df, by, level=median_ci_level):
+  """ Returns a dataframe indexed by the groups of the columns given with the median daily offer
+  spending of each group, its confidence interval bounds (see getMedianConfidenceIntervals) and the
+  group size
+  """
+
+  col = "daily_offer_spending"
+  spendings = df.groupby(by)[col].agg(["median", "size"])
+  spendings.columns = ["spending_median", "size"]
+
+  # Intervals of the observed groups, aligned to the groups of the aggregation
+  observed = df.groupby(by, observed=True)
+  group_no = observed.ngroup()
+  # Rows with missing group values aren't in any group
+  has_group = group_no.notna().to_numpy()
+  values = df[col].to_numpy(dtype=np.float64)[has_group]
+  groups = group_no[has_group].to_numpy(dtype=np.int64)
+  ci_low, ci_high = getMedianConfidenceIntervals(values, groups, observed.ngroups, level)
+  ci = pd.DataFrame({
+    "spending_median_ci_low": ci_low,
+    "spending_median_ci_high": ci_high,
+  }, index=observed.size().index).reindex(spendings.index)
+
+  spendings.insert(1, "spending_median_ci_low", ci["spending_median_ci_low"].to_numpy())
+  spendings.insert(2, "spending_median_ci_high", ci["spending_median_ci_high"].to_numpy())
+
+  return spendings
+
+
+@instrument
+def cachedCreateSpendingsStats(demog_spendings):
+  return runStage("spendings_stats", createSpendingsStats, args=(demog_spendings,), persist=False)
+
+@instrument
+def createSpendingsStats(demog_spendings):
+  """ Returns a dataframe with the mean daily spending of the groups of each demographic feature
+  (and of each offer) and its 95% confidence interval (normal approximation)
+  """
+
+  stats = []
+  for feat in ["age_group", "income_group", "cohort_group", "gender", "offer_code"]:
+    feat_stats = demog_spendings.groupby(feat, observed=True)["daily_offer_spending"].agg(["mean", "sem", "size"])
+    feat_stats["ci_low"] = feat_stats["mean"] - 1.96*feat_stats["sem"].fillna(0)
+    feat_stats["ci_high"] = feat_stats["mean"] + 1.96*feat_stats["sem"].fillna(0)
+    feat_stats = feat_stats.drop(columns="sem").rename_axis("group").reset_index()
+    feat_stats.insert(0, "feature", feat)
+    stats.append(feat_stats)
+
+  return pd.concat(stats, ignore_index=True)
+
+
+@instrument
+def cachedCreateSpendingsCube(demog_spendings, demographics):
+  return runStage("spendings_cube", createSpendingsCube, args=(demog_spendings, demographics), persist=False)
+
+@instrument
+def createSpendingsCube(demog_spendings, demographics):
+  """ Returns the aggregation cube of the spendings per demographic group, a dict containing for every
+  subset of the demographic features (as a tuple in the order of demog_cols):
+  - "spendings": dataframe indexed by the groups and the offer code with the spendings median (and
+    its confidence interval) and size
+  - "customers": series indexed by the groups with the number of customers
+  """
+
+  demog_cols = ["age_group", "income_group", "cohort_group", "gender"]
+  cube = {"spendings": {}, "customers": {}}
+  for n_feats in range(len(demog_cols)+1):
+    for feats in itertools.combinations(demog_cols, n_feats):
+      spendings = aggregateSpendings(demog_spendings, list(feats) + ["offer_code"])
+      cube["spendings"][feats] = spendings
+
+      if feats:
+        cube["customers"][feats] = demographics.groupby(list(feats)).size()
+      else:
+        cube["customers"][feats] = pd.Series([demographics.shape[0]])
+
+  return cube
+
+
+@instrument
+def updateSpendingsCube(cube, new_demographics, demog_spendings=None, new_demog_spendings=None):
+  """ Returns the aggregation cube (see createSpendingsCube) updated with new customers, without
+  rebuilding it
+
+  The customers of the new demographics (grouped with the same demographic bins) are added to the
+  counts of their groups. If the spendings of new offers received are given (new_demog_spendings, as
+  rows of the demog_spendings that already include them), only the groups with new spendings are
+  aggregated again, since their medians can't be updated from the previous ones.
+  """
+
+  demog_cols = ["age_group", "income_group", "cohort_group", "gender"]
+  updated = {"spendings": dict(cube["spendings"]), "customers": {}}
+  for feats, customers in cube["customers"].items():
+    if feats:
+      new_customers = new_demographics.groupby(list(feats)).size()
+      unseen = new_customers[~new_customers.index.isin(customers.index)]
+      customers = customers + new_customers.reindex(customers.index, fill_value=0)
+      if not unseen.empty:
+        customers = pd.concat([customers, unseen]).sort_index()
+    else:
+      customers = customers + new_demographics.shape[0]
+    updated["customers"][feats] = customers
+
+  if new_demog_spendings is None or new_demog_spendings.empty:
+    return updated
+
+  # Codes of the groups of each column (factorized once), combined into a group key of each subset
+  is_new = demog_spendings.index.isin(new_demog_spendings.index)
+  codes = {col: pd.factorize(demog_spendings[col])[0].astype(np.int64) + 1 for col in demog_cols + ["offer_code"]}
+  for feats, spendings in cube["spendings"].items():
+    by = list(feats) + ["offer_code"]
+    keys = np.zeros(demog_spendings.shape[0], dtype=np.int64)
+    for col in by:
+      keys = keys * (codes[col].max() + 1) + codes[col]
+    touched_rows = demog_spendings[np.isin(keys, keys[is_new])]
+    touched = aggregateSpendings(touched_rows, by)
+    touched = touched[touched["size"] > 0]
+    spendings = pd.concat([spendings.drop(touched.index, errors="ignore"), touched]).sort_index()
+    updated["spendings"][feats] = spendings
+
+  return updated
+
+
+@instrument
+def getCubeGroup(cube_table, group_def):
+  """ Returns the rows of a cube table (from the subset of features in the group definition) of a
+  demographic group, with the group levels dropped
+  """
+
+  demog_cols = ["age_group", "income_group", "cohort_group", "gender"]
+  group = dict(group_def)
+  feats = tuple(col for col in demog_cols if col in group)
+
+  table = cube_table[feats]
+  if not feats:
+    return table
+  if not isinstance(table.index, pd.MultiIndex):
+    return table[table.index==group[feats[0]]]
+  try:
+    return table.xs(tuple(group[col] for col in feats), level=list(feats))
+  except KeyError:
+    return table.iloc[:0]
+
+
+@instrument
+def spendingsForOffers(df, offers, demog_feats, min_group_size, cube=None):
+  """Returns a dataframe containing the spendings filtered by offers and grouped by demographic groups
+
+  When a single offer is selected the spendings are looked up from the aggregation cube, if given
+  (medians of several offers together can't be composed from the cube)
+  """
 
-  # Filter by offer types and group by demographic groups
-  agg_metrics = {"daily_offer_spending": ["median","size"]}
-  metric_names = ["spending_median", "size"]
-  spendings = df[df["offer_code"].isin(offers)].groupby(demog_feats).agg(agg_metrics).reset_index()
-  spendings.columns = demog_feats + metric_names
+  metric_names = ["spending_median", "spending_median_ci_low", "spending_median_ci_high", "size"]
+
+  if cube is not None and len(offers) == 1:
+    # Lookup the demographic groups for the offer
+    feats = tuple(col for col in ["age_group", "income_group", "cohort_group", "gender"] if col in demog_feats)
+    spendings = cube["spendings"][feats].xs(offers[0], level="offer_code", drop_level=True)
+    spendings = spendings.reset_index()[demog_feats + metric_names]
+    # Same groups as grouping the offer's rows: every category, but only values of non categorical
+    # features that were observed for the offer
+    for col in demog_feats:
+      if not isinstance(spendings[col].dtype, pd.CategoricalDtype):
+        observed = spendings.loc[spendings["size"]>0, col].unique()
+        spendings = spendings[spendings[col].isin(observed)]
+  else:
+    # Filter by offer types and group by demographic groups
+    spendings = aggregateSpendings(df[df["offer_code"].isin(offers)], demog_feats).reset_index()
 
   # Filter by group size and sort by spending
   spendings = spendings[spendings["size"]>=min_group_size]
@@ -401,19 +887,28 @@ def spendingsForOffers(df, offers, demog_feats, min_group_size):
   return spendings
 
 
-def bestOfferForGroup(df, portfolio, group_def):
+@instrument
+def bestOfferForGroup(df, portfolio, group_def, cube=None):
   """ Returns the best offer for a demographic group
+
+  If the aggregation cube is given, the spendings of the group are looked up from it
   """
 
-  # Filter demographic group
-  for feat_col, group in group_def:
-    df = df[df[feat_col]==group]
+  metric_names = ["spending_median", "spending_median_ci_low", "spending_median_ci_high", "size"]
+
+  if cube is not None:
+    # Lookup the demographic group (only offers sent to the group)
+    df = getCubeGroup(cube["spendings"], group_def)
+    df = df[df["size"]>0].reset_index()
+    df = df[["offer_code"] + metric_names]
+  else:
+    # Filter demographic group
+    for feat_col, group in group_def:
+      df = df[df[feat_col]==group]
 
-  # Group by offer code
-  agg_metrics = {"daily_offer_spending": ["median","size"]}
-  metric_names = ["spending_median", "size"]
-  df = df.groupby("offer_code").agg(agg_metrics).reset_index()
-  df.columns = ["offer_code"] + metric_names
+    # Group by offer code
+    df = aggregateSpendings(df, "offer_code").reset_index()
+    df = df[df["size"]>0]
 
   # Sort
   df = df.sort_values("spending_median", ascending=False)  
@@ -421,10 +916,24 @@ def bestOfferForGroup(df, portfolio, group_def):
   return df.head()
 
 
-def getGroupStats(group_def, demographics, demog_spendings):
+@instrument
+def getGroupStats(group_def, demographics, demog_spendings, cube=None):
   """ Returns some metrics corresponding to a demographic group
+
+  If the aggregation cube is given, the metrics are looked up from it
   """
 
+  if cube is not None:
+    customers = getCubeGroup(cube["customers"], group_def)
+    spendings = getCubeGroup(cube["spendings"], group_def)
+
+    # Calculate metrics
+    n_customers = int(customers.sum())
+    n_offers_sent = int(spendings["size"].sum())
+    n_unique_offers = int((spendings["size"]>0).sum())
+
+    return n_customers, n_offers_sent, n_unique_offers
+
   # Filter demographic group
   for feat_col, group in group_def:
     demographics = demographics[demographics[feat_col]==group]
@@ -438,8 +947,170 @@ def getGroupStats(group_def, demographics, demog_spendings):
   return n_customers, n_offers_sent, n_unique_offers
 
 
-def getCustomerTimeline(transcript_df, customer):
-  df = transcript_df[transcript_df["person"]==customer]
+@instrument
+def getCustomerTimeline(transcript_df, customer, person_index=None):
+  if person_index is not None:
+    df = getPersonRows(transcript_df, person_index, customer)
+  else:
+    df = transcript_df[transcript_df["person"]==customer]
   df = df.drop(columns=["person"]).set_index("event_no")
 
   return df
+
+
+@instrument
+def cachedCreatePersonIndex(df):
+  return runStage("person_index", createPersonIndex, args=(df,), persist=False)
+
+@instrument
+def createPersonIndex(df):
+  """ Returns the dataframe sorted by person and a dataframe indexed by person with the offsets
+  [start, end) of each person's block of rows, so that customer lookups are slices of the data
+
+  The rows of each person are kept in the order of their events (by event number, if there is one)
+  """
+
+  sort_cols = ["person", "event_no"] if "event_no" in df else ["person"]
+  in_order = df["person"].is_monotonic_increasing
+  if in_order and "event_no" in df:
+    persons, event_no = getCodes(df["person"]), df["event_no"].to_numpy()
+    in_order = bool(np.all((persons[1:] != persons[:-1]) | (event_no[1:] > event_no[:-1])))
+  if not in_order:
+    df = df.sort_values(sort_cols, kind="mergesort")
+
+  # Rows where each person's block starts
+  persons = getCodes(df["person"])
+  block_starts = np.flatnonzero(persons[1:] != persons[:-1]) + 1
+  starts = np.concatenate([[0], block_starts]) if len(persons) > 0 else block_starts
+  ends = np.append(starts[1:], len(persons))
+
+  person_index = pd.DataFrame({"start": starts, "end": ends}, index=df["person"].iloc[starts].to_numpy())
+  person_index.index.name = "person"
+
+  return df, person_index
+
+
+@instrument
+def getPersonRows(df, person_index, person):
+  """ Returns the rows of a person from a dataframe sorted by person using its offsets index
+  """
+
+  if person not in person_index.index:
+    return df.iloc[:0]
+
+  start, end = person_index.loc[person, ["start", "end"]]
+  return df.iloc[start:end]
+
+
+@instrument
+def getPersonsRows(df, person_index, persons):
+  """ Returns the rows of several persons (in the order given, without repetition) from a dataframe
+  sorted by person using its offsets index
+  """
+
+  offsets = person_index.reindex(pd.unique(np.asarray(persons))).dropna().astype(int)
+  lengths = (offsets["end"] - offsets["start"]).to_numpy()
+
+  # Positions of every row in the persons' blocks
+  block_offsets = np.repeat(offsets["start"].to_numpy() - np.cumsum(lengths) + lengths, lengths)
+  rows = block_offsets + np.arange(lengths.sum())
+
+  return df.iloc[rows]
+
+
+@instrument
+def getFeaturesAsOf(persons, times, df, person_index=None):
+  """ Returns a dataframe with a row for each person and time (in the order given) containing the
+  features of the person as of all their events strictly before that time, i.e. the features that a
+  new event at that time would have (the columns of the event itself are left empty)
+
+  Only the blocks of rows of the persons queried are sliced from the features sorted by person (see
+  createPersonIndex, applied if the offsets index isn't given) and each query is located with a
+  binary search in its person's block, so any past or future time can be queried without
+  recomputing the features, at a cost of the rows of the persons queried.
+  """
+
+  if person_index is None:
+    df, person_index = createPersonIndex(df)
+
+  persons = np.asarray(persons)
+  times = np.broadcast_to(np.asarray(times), persons.shape).astype(np.int64)
+  query_persons = pd.unique(persons)
+  unknown = person_index.index.get_indexer(query_persons) < 0
+  if unknown.any():
+    raise KeyError(f"Unknown persons: {', '.join(map(str, np.sort(query_persons[unknown])))}")
+
+  # Blocks of rows of the persons queried (in the order of query_persons)
+  df = getPersonsRows(df, person_index, query_persons)
+  lengths = (person_index["end"] - person_index["start"]).reindex(query_persons).to_numpy()
+  blocks = pd.Index(query_persons).get_indexer(persons)
+  starts = (np.cumsum(lengths) - lengths)[blocks]
+
+  # Sort key of the rows by person block and time (the rows of each block are sorted by time)
+  row_times = df["time"].to_numpy(dtype=np.int64)
+  min_time = min(row_times.min(), times.min()) if len(row_times) > 0 else 0
+  time_span = max(row_times.max(), times.max()) - min_time + 1 if len(row_times) > 0 else 1
+  row_keys = np.repeat(np.arange(len(lengths)), lengths) * time_span + (row_times - min_time)
+  query_keys = blocks * time_span + (times - min_time)
+
+  # Last event of each person before the time (queries without one take the person's first row
+  # for the demographic data and start from empty aggregates)
+  last_rows = np.searchsorted(row_keys, query_keys, side="left") - 1
+  has_events = last_rows >= starts
+  feats = df.iloc[np.where(has_events, last_rows, starts)]
+  last_event = feats["event"].to_numpy()
+  delta_time = times - feats["time"].to_numpy(dtype=np.int64)
+
+  # Aggregates of the rows (their own event excluded) plus their own event
+  cols = {"time": times}
+  for col, cum_col in agg_cols.items():
+    event_value = (last_event==col) if col in event_types else feats[col].to_numpy(dtype=np.float64)
+    cols[cum_col] = np.where(has_events, feats[cum_col].to_numpy(dtype=np.float64) + event_value, 0)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    cols["atv"] = cols["cum_spending"] / cols["transactions"]
+    cols["offer_usage"] = cols["offers_completed"] / cols["offers_received"]
+
+  cols["time_since_first_event"] = np.where(
+    has_events, feats["time_since_first_event"].to_numpy(dtype=np.float64) + delta_time, 0)
+  for event in event_types:
+    col_time_since = f"time_since_last_{event.replace(' ','_')}"
+    time_since = np.where(last_event==event, 0, feats[col_time_since].to_numpy(dtype=np.float64))
+    cols[col_time_since] = np.where(has_events, time_since + delta_time, np.nan)
+
+  # Offers received before the time that are still valid: for each offer code, the latest validity
+  # end among the offers received up to each row, taken at the last one received before the time
+  received = (df["event"]=="offer received").to_numpy()
+  offer_code = df["offer_code"].to_numpy()
+  valid_until = (df["time"] + df["offer_duration"]).to_numpy(dtype=np.float64)
+  for col_active in [col for col in df.columns if col.startswith("active_")]:
+    offer_rows = np.flatnonzero(received & (offer_code==col_active[len("active_"):]))
+    if len(offer_rows) == 0:
+      cols[col_active] = np.zeros(len(persons))
+      continue
+    offer_blocks = row_keys[offer_rows] // time_span
+    offer_end = pd.Series(valid_until[offer_rows]).groupby(offer_blocks).cummax().to_numpy()
+    last_offer = np.searchsorted(row_keys[offer_rows], query_keys, side="left") - 1
+    found = last_offer >= 0
+    last_offer = np.maximum(last_offer, 0)
+    cols[col_active] = found & (offer_blocks[last_offer]==blocks) & (times < offer_end[last_offer])
+
+  # Columns of the event itself (no event happened at the time)
+  offer_cols = [col for col in df.columns if col.startswith("offer_") and col not in cols]
+  for col in ["event", "amount", "offer_id", "reward"] + offer_cols:
+    if isinstance(df[col].dtype, pd.CategoricalDtype):
+      cols[col] = pd.Categorical.from_codes(np.full(len(persons), -1), dtype=df[col].dtype)
+    elif col in ["amount", "reward"] or col.startswith("offer_type_"):
+      cols[col] = np.zeros(len(persons))
+    else:
+      cols[col] = np.full(len(persons), np.nan)
+
+  as_of_feats = {}
+  for col in df.columns:
+    if col not in cols:
+      as_of_feats[col] = feats[col].array
+    elif isinstance(df[col].dtype, pd.CategoricalDtype):
+      as_of_feats[col] = cols[col]
+    else:
+      as_of_feats[col] = np.asarray(cols[col]).astype(df[col].dtype, copy=False)
+
+  return pd.DataFrame(as_of_feats)
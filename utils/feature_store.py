@@ -0,0 +1,229 @@
+import os
+import shutil
+import time
+from .extract_transform import *
+from .stage_cache import readStage, writeStage
+
+# Folder of the feature store: the features, targets and state with the updates applied (kept apart
+# from the stage cache, whose least recently used entries are deleted)
+feature_store_dir = "feature_store"
+
+# Cumulative features and the column (or event dummy) accumulated by each of them
+cumulative_cols = {
+  "cum_spending": "amount",
+  "cum_reward": "reward",
+  "transactions": "transaction",
+  "offers_received": "offer received",
+  "offers_viewed": "offer viewed",
+  "offers_completed": "offer completed",
+}
+state_events = ["offer received", "offer viewed", "transaction", "offer completed"]
+
+
+def createFeatureState(transcript_feats, portfolio_df):
+  """ Returns a dataframe indexed by person with the running state needed to compute the features of
+  new events: cumulative aggregates (including every event seen), first and last event times and the
+  time until each offer received is valid
+  """
+
+  # The last row of each person holds the aggregates of all events before it
+  last_rows = transcript_feats.groupby("person", sort=False, observed=True).tail(1).set_index("person")
+
+  state = pd.DataFrame(index=last_rows.index)
+  state["event_no"] = last_rows["event_no"]
+  for cum_col, col in cumulative_cols.items():
+    own_value = last_rows[col] if col not in state_events else 1*(last_rows["event"]==col)
+    state[cum_col] = last_rows[cum_col] + own_value
+  state["first_time"] = last_rows["time"] - last_rows["time_since_first_event"]
+  state["last_time"] = last_rows["time"]
+
+  # Last time of each type of event
+  for event in state_events:
+    event_name = event.replace(' ','_')
+    event_rows = transcript_feats[transcript_feats["event"]==event]
+    state[f"last_{event_name}_at"] = event_rows.groupby("person", observed=True)["time"].max()
+
+  # Latest time until each offer received is valid
+  received = transcript_feats[transcript_feats["event"]=="offer received"]
+  valid_until = (received["time"] + received["offer_duration"]).groupby(
+    [received["person"], received["offer_code"]], observed=True).max().unstack()
+  for code in sorted(portfolio_df["code"]):
+    col_valid_until = valid_until[code] if code in valid_until else np.nan
+    state[f"active_until_{code}"] = col_valid_until
+
+  return state
+
+
+def updateFeatures(new_events, transcript_feats, Y_df, state, portfolio_df, profile_df):
+  """ Applies a batch of new raw transcript events (same records as transcript.json) and returns the
+  updated transcript_feats, Y_df and state
+
+  Only the features of the new events are computed, seeded by the state of their customers, and
+  only the targets that are missing, that can now be closed or whose windows contain the new events
+  are (re)calculated. New events must not occur before the last event already applied for the same
+  customer.
+  """
+
+  if len(new_events) == 0:
+    return transcript_feats, Y_df, state
+
+  new_df = parseTranscriptRecords(new_events)
+  # Keep the schema of the features (the ids of the new events must be in the compact schema ids)
+  id_dtypes = getIdDtypes(transcript_feats)
+  if id_dtypes is not None:
+    new_df = compactFrame(new_df, id_dtypes)
+  new_df = new_df.sort_values(["person", "time"], kind="mergesort").reset_index(drop=True)
+  prev_state = state.reindex(new_df["person"])
+
+  if (new_df["time"].to_numpy() < prev_state["last_time"].to_numpy()).any():
+    raise ValueError("New events occur before events already applied to the feature state")
+
+  # Continue the event numbering of each person
+  event_no = new_df.groupby("person", observed=True).cumcount() + 1 + prev_state["event_no"].fillna(0).to_numpy()
+  new_df.insert(1, "event_no", event_no.astype(transcript_feats["event_no"].dtype))
+
+  # Features of the new events as if they were the only ones
+  new_feats = createTranscriptFeatures(new_df, portfolio_df, profile_df)
+
+  # Seed the features with the aggregates of the events already applied
+  for cum_col in cumulative_cols:
+    new_feats[cum_col] += prev_state[cum_col].fillna(0).to_numpy()
+  first_time = prev_state["first_time"].to_numpy()
+  new_feats["time_since_first_event"] = np.where(
+    np.isnan(first_time), new_feats["time_since_first_event"], new_feats["time"] - first_time)
+  new_feats["atv"] = new_feats["cum_spending"] / new_feats["transactions"]
+  new_feats["offer_usage"] = new_feats["offers_completed"] / new_feats["offers_received"]
+  for event in state_events:
+    event_name = event.replace(' ','_')
+    col_time_since = f"time_since_last_{event_name}"
+    state_time_since = new_feats["time"] - prev_state[f"last_{event_name}_at"].to_numpy()
+    new_feats[col_time_since] = new_feats[col_time_since].fillna(state_time_since)
+  for code in sorted(portfolio_df["code"]):
+    state_active = (prev_state[f"active_until_{code}"].to_numpy() > new_feats["time"].to_numpy())
+    new_feats[f"active_{code}"] = (new_feats[f"active_{code}"].astype(bool) | state_active).astype(int)
+
+  new_feats = new_feats[transcript_feats.columns]
+  if id_dtypes is not None:
+    new_feats = compactFrame(new_feats, id_dtypes)
+  transcript_feats = pd.concat([transcript_feats, new_feats], ignore_index=True)
+
+  # Update the state of the affected customers (keeping the latest times seen)
+  new_state = createFeatureState(new_feats, portfolio_df)
+  prev_state = state.reindex(new_state.index)
+  for col in new_state.columns:
+    if col.startswith("last_") or col.startswith("active_until_"):
+      new_state[col] = np.fmax(new_state[col], prev_state[col])
+  state = pd.concat([state.drop(index=new_state.index, errors="ignore"), new_state])
+
+  Y_df = updateTargets(Y_df, transcript_feats, new_feats, portfolio_df)
+
+  return transcript_feats, Y_df, state
+
+
+def updateTargets(Y_df, transcript_feats, new_feats, portfolio_df):
+  """ Returns Y_df with the targets of new received offers added and the targets whose time
+  windows could not be closed before, or that contain the new events, recalculated
+  """
+
+  last_event_time = transcript_feats["time"].max()
+  time_windows = sorted(24*portfolio_df["duration"].unique())
+  target_cols = [f"spending_next_{time_window}h" for time_window in time_windows]
+
+  # Targets to calculate: open windows, windows of the customers of the new events that contain them
+  # (new events may be older than the last event of other customers, so windows closed before may
+  # change) and offers just received
+  first_new_time = new_feats.groupby("person", observed=True)["time"].min()
+  target_first_new_time = first_new_time.reindex(Y_df["person"]).to_numpy(dtype=np.float64)
+  stale_targets = Y_df[target_cols].isna().any(axis=1) | (
+    Y_df["time"].to_numpy(dtype=np.float64) + max(time_windows) > target_first_new_time)
+  new_received = new_feats.loc[new_feats["event"]=="offer received", ["person","time"]]
+  queries = pd.concat([Y_df.loc[stale_targets, ["person","time"]], new_received], ignore_index=True)
+  if len(queries) == 0:
+    return Y_df
+
+  # Only events of the customers and times that can fall inside the windows are needed
+  events = transcript_feats[["person","time","event","amount"]]
+  events = events[
+    events["event"].isin(["offer received", "transaction"]) &
+    (events["time"] >= queries["time"].min()) &
+    events["person"].isin(queries["person"].unique())
+  ]
+
+  spendings = getFutureSpendings(events, queries, time_windows, last_event_time)
+  queries[target_cols] = spendings
+
+  id_dtypes = getIdDtypes(Y_df)
+  if id_dtypes is not None:
+    queries = compactFrame(queries, id_dtypes)
+
+  Y_df = Y_df[~stale_targets]
+  return pd.concat([Y_df, queries], ignore_index=True)
+
+
+def saveFeatureStore(transcript_feats, Y_df, state, path=feature_store_dir):
+  """ Writes the features, targets and state to a new version of the feature store (parquet files,
+  see writeStage) and makes it the current version atomically, deleting the previous ones
+  """
+
+  os.makedirs(path, exist_ok=True)
+  version = f"v{time.time_ns()}"
+  writeStage(os.path.join(path, version), (transcript_feats, Y_df, state))
+
+  tmp_path = os.path.join(path, f"CURRENT.tmp{os.getpid()}")
+  with open(tmp_path, "w") as handle:
+    handle.write(version)
+  os.replace(tmp_path, os.path.join(path, "CURRENT"))
+
+  for entry in os.scandir(path):
+    if entry.is_dir() and entry.name != version and ".tmp" not in entry.name:
+      shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def loadFeatureStore(path=feature_store_dir):
+  """ Returns the features, targets and state of the current version of the feature store, or None
+  if no updates were saved
+  """
+
+  try:
+    with open(os.path.join(path, "CURRENT")) as handle:
+      version = handle.read().strip()
+  except FileNotFoundError:
+    return None
+
+  return readStage(os.path.join(path, version))
+
+
+def getFeaturesAndTargets(transcript_df, portfolio_df, profile_df, path=feature_store_dir):
+  """ Returns the features and targets with the updates saved to the feature store or, if there are
+  none, those of the transcript (from the stage cache)
+
+  This is how the scoring service and the training read the features (and the app, through its
+  artifacts), so that they pick up the updates applied with updateFeatureStore on their next start.
+  Delete the feature store to go back to the features of the transcript.
+  """
+
+  store = loadFeatureStore(path)
+  if store is not None:
+    return store[0], store[1]
+
+  transcript_feats = cachedCreateTranscriptFeatures(transcript_df, portfolio_df, profile_df)
+  return transcript_feats, cachedCreateTargets(transcript_feats, portfolio_df)
+
+
+def updateFeatureStore(new_events, transcript_df, portfolio_df, profile_df, path=feature_store_dir):
+  """ Applies a batch of new raw transcript events to the feature store (see updateFeatures), started
+  from the features of the transcript if it is empty, and saves it; returns the updated features,
+  targets and state
+  """
+
+  store = loadFeatureStore(path)
+  if store is not None:
+    transcript_feats, Y_df, state = store
+  else:
+    transcript_feats, Y_df = getFeaturesAndTargets(transcript_df, portfolio_df, profile_df, path)
+    state = createFeatureState(transcript_feats, portfolio_df)
+
+  transcript_feats, Y_df, state = updateFeatures(new_events, transcript_feats, Y_df, state, portfolio_df, profile_df)
+  saveFeatureStore(transcript_feats, Y_df, state, path)
+
+  return transcript_feats, Y_df, state
@@ -1,19 +1,76 @@
+import os
 import pickle
+import threading
 import streamlit as st
 from .extract_transform import *
+from .feature_store import getFeaturesAndTargets
+from .profiling import instrument
 
 inference_time_windows = [72, 96, 120, 168, 240]
+default_model_version = "v2"
 
-def loadModels():
+
+def getModelsPath(version):
+  """ Returns the path of the file of the models of a version
+  """
+
+  return f"models/models_{version}.pickle"
+
+
+# Models loaded in this process by version: (file modification time, models)
+_models_registry = {}
+_models_registry_lock = threading.Lock()
+
+@instrument
+def loadModels(version=default_model_version, reload=False):
   """ Loads the fitted predictive models to infer the customer's spendings for different offers
+
+  Each version is unpickled once per process and the same objects are returned on later calls,
+  unless its file changed since it was loaded (or a reload is forced)
+  """
+
+  path = getModelsPath(version)
+  mtime = os.stat(path).st_mtime_ns
+
+  with _models_registry_lock:
+    loaded = _models_registry.get(version)
+    if reload or loaded is None or loaded[0] != mtime:
+      with open(path, "rb") as handle:
+        models = pickle.load(handle)
+      _models_registry[version] = (mtime, models)
+
+    return _models_registry[version][1]
+
+
+@instrument
+def loadInferenceState(model_version=default_model_version):
+  """ Loads (from the stage cache when possible) everything needed to predict the spendings of any
+  customer: portfolio, profiles, customers' features (in the compact schema, with the updates of the
+  feature store) indexed by person and the models
   """
 
-  with open("models/models_v2.pickle", "rb") as handle:
-    models = pickle.load(handle)
+  portfolio_df = cachedLoadAndCleanPortfolio()
+  profile_df = cachedLoadAndCleanProfile()
+  id_dtypes = createIdDtypes(portfolio_df, profile_df)
+  portfolio_df = cachedCompactFrame(portfolio_df, id_dtypes)
+  profile_df = cachedCompactFrame(profile_df, id_dtypes)
+  transcript_df = cachedLoadAndCleanTranscript(id_dtypes)
+  transcript_feats, _ = getFeaturesAndTargets(transcript_df, portfolio_df, profile_df)
+  transcript_feats, feats_index = cachedCreatePersonIndex(transcript_feats)
+  loadModels(model_version)
 
-  return models
+  return {
+    "portfolio_df": portfolio_df,
+    "profile_df": profile_df,
+    "transcript_feats": transcript_feats,
+    "feats_index": feats_index,
+    "feature_cols": list(dropAuxFeatures(transcript_feats.iloc[:0]).columns),
+    "next_time": int(transcript_feats["time"].max()) + 1,
+    "model_version": model_version,
+  }
 
 
+@instrument
 def splitFeaturesTarget(df):
   """ Given the full dataset, it splits into two dataframes: the features and the targets
   """
@@ -22,17 +79,45 @@ def splitFeaturesTarget(df):
   return df.drop(columns=target_cols), df[target_cols]
 
 
-def getCustomerFeatures(customer, time, df, portfolio_df):
+@instrument
+def getCustomerFeatures(customer, time, df, portfolio_df, person_index=None):
   """ Returns a dataframe containing a single row representing the customer with the features for
   inputting into the predictive model
   """
-  
-  customer_df = df[df["person"]==customer].copy()
-  row_customer = customer_df.nlargest(1, "event_no")
 
-  # Calculate time since last event occurred
-  delta_time = time - row_customer["time"]
-  # Add this delta time to the time features
+  return getCustomersFeatures([customer], time, df, portfolio_df, person_index)
+
+
+@instrument
+def getProjectedFeatures(customers, times, df, person_index=None):
+  """ Returns the features of the last event of each customer and the columns changed by projecting
+  them to the corresponding time (time features and offers still active), as arrays of the customers
+
+  Raises a KeyError naming the customers without events (or unknown), which can't be projected
+  """
+
+  if person_index is not None:
+    customers_df = getPersonsRows(df, person_index, customers)
+  else:
+    customers_df = df[df["person"].isin(customers)]
+  # Group the customers' rows by their plain ids (the categories of the compact schema are the ids of
+  # all customers and would be hashed to reindex by them)
+  if isinstance(customers_df["person"].dtype, pd.CategoricalDtype):
+    customers_df = customers_df.assign(person=customers_df["person"].to_numpy(dtype=object))
+
+  # Last event of each customer
+  last_rows = customers_df.groupby("person", observed=True)["event_no"].idxmax().reindex(customers)
+  if last_rows.isna().any():
+    unknown = np.unique(np.asarray(customers)[last_rows.isna().to_numpy()])
+    raise KeyError(f"Unknown persons or without events: {', '.join(map(str, unknown))}")
+  customers_feats = df.loc[last_rows.to_numpy()]
+
+  # Columns changed from the last event, as arrays of the customers (so that the dataframe is built
+  # once instead of setting each column)
+  customer_cols = {}
+
+  # Calculate time since last event occurred and add this delta time to the time features
+  delta_time = times - customers_feats["time"].to_numpy()
   time_features = [
     "time_since_first_event",
     "time_since_last_offer_received",
@@ -41,63 +126,136 @@ def getCustomerFeatures(customer, time, df, portfolio_df):
     "time_since_last_offer_completed",
   ]
   for time_feat in time_features:
-    row_customer[time_feat] += delta_time
+    customer_cols[time_feat] = customers_feats[time_feat].to_numpy() + delta_time
+
+  # Determine if the last offer of each type received up until that time will still be valid
+  received = customers_df[customers_df["event"]=="offer received"].sort_values("event_no")
+  received = received.drop_duplicates(subset=["person","offer_code"], keep="last")
+  valid_until = (received["time"] + received["offer_duration"]).groupby(
+    [received["person"], received["offer_code"]], observed=True).max().unstack().reindex(customers)
+  for offer_code in valid_until.columns:
+    offer_valid_until = valid_until[offer_code].to_numpy()
+    col_active = f"active_{offer_code}"
+    customer_cols[col_active] = np.where(
+      np.isnan(offer_valid_until), customers_feats[col_active].to_numpy(), 1*(times < offer_valid_until))
+
+  return customers_feats, customer_cols
+
+
+def getOfferFeatures(offers_df, offer_types):
+  """ Returns the model features of the offers sent, as those of the offers received the models were
+  trained with (duration in hours and type one hot encoded), by column as arrays of the offers
+  """
+
+  offer_feats = {
+    f"offer_{col}": offers_df[col].to_numpy() for col in ["difficulty", "reward", "email", "mobile", "social", "web"]
+  }
+  offer_feats["offer_duration"] = 24 * offers_df["duration"].to_numpy(dtype=np.int64)
+  for offer_type in offer_types:
+    offer_feats[f"offer_type_{offer_type}"] = (offers_df["type"]==offer_type).to_numpy(dtype=int)
+
+  return offer_feats
 
-  # Determine if each offer received up until that time will still be valid
-  received = customer_df[customer_df["event"]=="offer received"].sort_values("event_no", ascending=False)
-  received = received.drop_duplicates(subset=["offer_code"])
-  for _, offer in received.iterrows():
-    valid_until = offer["time"] + offer["offer_duration"]
-    offer_code = offer["offer_code"]
-    row_customer[f"active_{offer_code}"] = 1*(time < valid_until)
 
-  # Set the offers
-  customer_with_offers = []
-  offer_cols = ["code", "difficulty", "reward", "duration", "email", "mobile", "social", "web"]
-  for _, row in portfolio_df.iterrows():
-    offer = row["code"]
-    row_customer_offer = row_customer.copy()
+@instrument
+def getCustomersFeatures(customers, times, df, portfolio_df, person_index=None, as_of=False):
+  """ Returns a dataframe with a row for each customer and offer in the portfolio (customer major)
+  containing the features for inputting into the predictive model, simulating the offer being sent
+  at the corresponding time
 
-    # Set the offer to active
-    row_customer_offer[f"active_{offer}"] = 1
+  By default the features are projected forward from the customers' last event. If as_of is set,
+  they are the exact features as of the times instead (see getFeaturesAsOf), which can also be
+  past times, e.g. for backtesting.
+
+  If the person offsets index of the dataframe is given, the customers' rows are sliced from it
+  instead of scanning the whole dataframe
+  """
 
-    # Set all features related to the offer being sent
-    for offer_col in offer_cols:
-      row_customer_offer[f"offer_{offer_col}"] = row[offer_col]
+  customers = np.asarray(customers)
+  times = np.broadcast_to(np.asarray(times), customers.shape)
+  if as_of:
+    customers_feats, customer_cols = getFeaturesAsOf(customers, times, df, person_index), {}
+  else:
+    customers_feats, customer_cols = getProjectedFeatures(customers, times, df, person_index)
 
-    # Plus the type of the offer
-    offer_type = row["type"]
-    row_customer_offer[f"offer_type_{offer_type}"] = 1
+  # Set the offers: repeat each customer once per offer and broadcast the offer data over them
+  n_offers = portfolio_df.shape[0]
+  repeated = np.repeat(np.arange(len(customers)), n_offers)
+  customers_feats = customers_feats.iloc[repeated]
+  offer_cols = {col: values[repeated] for col, values in customer_cols.items()}
+  offer_cols["offer_code"] = np.tile(portfolio_df["code"].to_numpy(), len(customers))
+  offer_types = [col[len("offer_type_"):] for col in customers_feats.columns if col.startswith("offer_type_")]
+  for col, values in getOfferFeatures(portfolio_df, offer_types).items():
+    offer_cols[col] = np.tile(values, len(customers))
 
-    # Append the row with the offer
-    customer_with_offers.append(row_customer_offer)
-  
-  # Concatenate all the offers to simulate
-  customerFeats = pd.concat(customer_with_offers)
+  # Set the offer sent to active
+  sent_offer = np.tile(np.arange(n_offers), len(customers))
+  for i, offer_code in enumerate(portfolio_df["code"]):
+    col_active = f"active_{offer_code}"
+    active = offer_cols.get(col_active, customers_feats[col_active].to_numpy())
+    offer_cols[col_active] = np.where(sent_offer==i, 1, active)
 
-  return customerFeats
+  customers_feats = pd.DataFrame({
+    col: offer_cols[col] if col in offer_cols else customers_feats[col].array
+    for col in customers_feats.columns
+  }, index=customers_feats.index)
 
+  return customers_feats
 
-def predictCustomerSpendings(df):
+
+@instrument
+def predictCustomerSpendings(df, id_cols=["offer_code"], model_version=default_model_version):
   """ Given a dataframe containing the features, predicts the spendings of all time windows
   """
 
   # Drop auxiliary features
-  df_with_pred = df[["offer_code"]].copy().reset_index(drop=True)
-  df = dropAuxFeatures(df)
+  df_with_pred = df[id_cols].copy().reset_index(drop=True)
+  spendings = predictSpendings(dropAuxFeatures(df), model_version)
+
+  return pd.concat([df_with_pred, spendings], axis=1)
+
+
+@instrument
+def predictSpendings(X, model_version=default_model_version):
+  """ Given the model features (without auxiliary columns), returns a dataframe with the spendings
+  predicted for all time windows
+  """
 
-  models = loadModels()
+  models = loadModels(model_version)
 
-  prev_spending = 0
-  for model in models:
-    col_target = model["target"].replace("spending_next_", "")
+  # Features converted once to a C ordered float32 matrix (per order of the features the models were
+  # trained with) and predicted in place by every model, without building a DMatrix per model
+  matrices = {}
+  increments = np.empty((X.shape[0], len(models)), dtype=np.float32)
+  for i, model in enumerate(models):
+    regressor = model["regressor"]
+    booster = regressor.get_booster()
+    feature_names = tuple(booster.feature_names or X.columns)
+    if feature_names not in matrices:
+      matrices[feature_names] = np.ascontiguousarray(X[list(feature_names)].to_numpy(dtype=np.float32))
 
-    # Predict
-    df_with_pred[col_target] = model["regressor"].predict(df)
+    # Trees up to the best iteration if the regressor was early stopped (as its predict does)
+    iteration_range = (0, getattr(regressor, "best_ntree_limit", 0))
+    increments[:, i] = booster.inplace_predict(matrices[feature_names], iteration_range=iteration_range)
+
+  # Recreate cumulative spending targets (since they were trained as incremental)
+  columns = [model["target"].replace("spending_next_", "") for model in models]
+  return pd.DataFrame(np.cumsum(increments, axis=1), columns=columns)
+
+
+@instrument
+def predictCustomersSpendings(customers, times, df, portfolio_df, person_index=None,
+                              model_version=default_model_version):
+  """ Predicts the spendings of all time windows for each offer in the portfolio being sent to each
+  customer at the corresponding time, with a single prediction per model for all of them
+  """
 
-    # Recreate cumulative spending target (since they were trained as incremental)
-    df_with_pred[col_target] += prev_spending
+  customers_feats = getCustomersFeatures(customers, times, df, portfolio_df, person_index)
+  customers_spendings = predictCustomerSpendings(
+    customers_feats, id_cols=["person","offer_code"], model_version=model_version)
 
-    prev_spending = df_with_pred[col_target]
+  n_offers = portfolio_df.shape[0]
+  times = np.broadcast_to(np.asarray(times), np.shape(customers))
+  customers_spendings.insert(1, "time", np.repeat(times, n_offers))
 
-  return df_with_pred
+  return customers_spendings
@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+from .extract_transform import *
+from .profiling import instrument
+
+
+@instrument
+def createPartitionBoundaries(profile_df, n_partitions):
+  """ Returns the person ids splitting the customers in n_partitions ranges of similar size (partition
+  i holds the persons from boundary i-1, included, up to boundary i)
+  """
+
+  persons = np.sort(profile_df["person"].astype(str).unique())
+  positions = (np.arange(1, n_partitions) * len(persons)) // n_partitions
+
+  return persons[positions]
+
+
+@instrument
+def getPersonPartitions(persons, boundaries):
+  """ Returns the partition (person range) of each person in a series
+  """
+
+  if isinstance(persons.dtype, pd.CategoricalDtype):
+    # Partition of each category, taken by the codes
+    category_partitions = np.searchsorted(boundaries, persons.cat.categories.to_numpy(dtype=object), side="right")
+    return category_partitions[persons.cat.codes.to_numpy()]
+
+  return np.searchsorted(boundaries, persons.to_numpy(dtype=object), side="right")
+
+
+@instrument
+def spillTranscript(spill_dir, boundaries, path="data/transcript.json", chunksize=100000, id_dtypes=None):
+  """ Reads the transcript in chunks and spills the parsed records of each person range partition to
+  its own folder of parquet files, so that no more than a chunk is held in memory
+
+  The number of partitions and the last event time of the whole transcript (needed by the targets)
+  are written to meta.json.
+  """
+
+  shutil.rmtree(spill_dir, ignore_errors=True)
+  os.makedirs(spill_dir)
+
+  last_event_time = None
+  reader = pd.read_json(path, orient='records', lines=True, chunksize=chunksize)
+  for i, chunk in enumerate(reader):
+    records = parseTranscriptRecords(chunk)
+    if id_dtypes is not None:
+      records = compactFrame(records, id_dtypes)
+    chunk_last_time = int(records["time"].max())
+    last_event_time = chunk_last_time if last_event_time is None else max(last_event_time, chunk_last_time)
+
+    partitions = getPersonPartitions(records["person"], boundaries)
+    for partition in np.unique(partitions):
+      partition_dir = os.path.join(spill_dir, f"part-{partition:05d}")
+      os.makedirs(partition_dir, exist_ok=True)
+      records[partitions==partition].reset_index(drop=True).to_parquet(
+        os.path.join(partition_dir, f"chunk-{i:05d}.parquet"))
+
+  with open(os.path.join(spill_dir, "meta.json"), "w") as handle:
+    json.dump({"n_partitions": len(boundaries) + 1, "last_event_time": last_event_time}, handle)
+
+  return spill_dir
+
+
+@instrument
+def loadTranscriptPartition(spill_dir, partition):
+  """ Returns the cleaned transcript of a spilled partition (as loadAndCleanTranscript would return
+  for its persons), or None if it has no events
+  """
+
+  partition_dir = os.path.join(spill_dir, f"part-{partition:05d}")
+  if not os.path.isdir(partition_dir):
+    return None
+
+  # Chunks in the order of the transcript file
+  chunks = [
+    pd.read_parquet(os.path.join(partition_dir, chunk_file))
+    for chunk_file in sorted(os.listdir(partition_dir))
+  ]
+
+  return sortAndNumberEvents(pd.concat(chunks, ignore_index=True))
+
+
+@instrument
+def createTrainingDatasetOutOfCore(spill_dir, out_dir, portfolio_df, profile_df):
+  """ Streams the spilled transcript partitions through the feature, target and training dataset
+  creation, writing df_full and the training dataset (df) of each partition as soon as it is done
+
+  Only one partition is held in memory at a time. Reading the partitions of out_dir/df_full and
+  out_dir/df in order (see readPartitions) gives the same rows as getTrainingDataset.
+  """
+
+  with open(os.path.join(spill_dir, "meta.json")) as handle:
+    meta = json.load(handle)
+  time_windows = sorted(24*portfolio_df["duration"].unique())
+
+  for name in ["df_full", "df"]:
+    shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+    os.makedirs(os.path.join(out_dir, name))
+
+  for partition in range(meta["n_partitions"]):
+    transcript_df = loadTranscriptPartition(spill_dir, partition)
+    if transcript_df is None:
+      continue
+
+    transcript_feats = createTranscriptFeatures(transcript_df, portfolio_df, profile_df)
+    del transcript_df
+
+    # Targets with the last event time of the whole transcript
+    target_df, Y_df = getTargetEvents(transcript_feats)
+    spendings = getFutureSpendings(target_df, Y_df, time_windows, meta["last_event_time"])
+    Y_df = setTargets(Y_df, spendings, time_windows, transcript_feats)
+
+    df_full, df = getTrainingDataset(transcript_feats, Y_df, return_df_full=True)
+    del transcript_feats, target_df, Y_df
+    df_full.to_parquet(os.path.join(out_dir, "df_full", f"part-{partition:05d}.parquet"))
+    df.to_parquet(os.path.join(out_dir, "df", f"part-{partition:05d}.parquet"))
+
+  return out_dir
+
+
+@instrument
+def iterPartitions(path, columns=None):
+  """ Yields the dataframes of the partition files of a folder in order
+  """
+
+  for part_file in sorted(os.listdir(path)):
+    if part_file.endswith(".parquet"):
+      yield pd.read_parquet(os.path.join(path, part_file), columns=columns)
+
+
+@instrument
+def readPartitions(path, columns=None):
+  """ Returns the dataframe of all the partition files of a folder concatenated in order
+  """
+
+  return pd.concat(iterPartitions(path, columns), ignore_index=True)
@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from .extract_transform import *
+from .profiling import instrument
+
+# Inputs of the stage being run in parallel, set before the worker processes are forked so that
+# they share the parent's memory (copy on write) instead of receiving pickled copies
+_shared_inputs = {}
+
+
+def getShards(persons, n_shards):
+  """ Returns the shard of each row given by a hash of its person (the same for its hex id in any
+  schema and in any process)
+  """
+
+  person_hash = pd.util.hash_pandas_object(persons, index=False).to_numpy()
+  return (person_hash % np.uint64(n_shards)).astype(np.int64)
+
+
+def runShards(worker, n_shards, n_jobs=None):
+  """ Returns the results of the worker applied to every shard (in shard order), running them in a
+  pool of forked processes (or serially if fork isn't available or a single job is requested)
+  """
+
+  n_jobs = min(n_jobs or os.cpu_count(), n_shards)
+  if n_jobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+    return [worker(shard) for shard in range(n_shards)]
+
+  with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+    return list(executor.map(worker, range(n_shards)))
+
+
+def _featuresShard(shard):
+  transcript_df, portfolio_df, profile_df, shards = _shared_inputs["features"]
+  return createTranscriptFeatures(transcript_df[shards==shard], portfolio_df, profile_df)
+
+
+@instrument
+def createTranscriptFeaturesParallel(transcript_df, portfolio_df, profile_df, n_jobs=None, n_shards=None):
+  """ Returns the same dataframe as createTranscriptFeatures, calculating the features of shards of
+  the persons in parallel processes and concatenating them in the order of the transcript rows
+  """
+
+  n_shards = n_shards or n_jobs or os.cpu_count()
+  shards = getShards(transcript_df["person"], n_shards)
+
+  _shared_inputs["features"] = (transcript_df, portfolio_df, profile_df, shards)
+  try:
+    shard_feats = runShards(_featuresShard, n_shards, n_jobs)
+  finally:
+    del _shared_inputs["features"]
+
+  # Restore the order of the rows (empty shards are left out so they don't change the dtypes)
+  rows = np.concatenate([np.flatnonzero(shards==shard) for shard in range(n_shards)])
+  shard_feats = [feats for feats in shard_feats if len(feats) > 0]
+  if not shard_feats:
+    return createTranscriptFeatures(transcript_df, portfolio_df, profile_df)
+  transcript_feats = pd.concat(shard_feats, ignore_index=True)
+  transcript_feats = transcript_feats.iloc[np.argsort(rows, kind="stable")]
+
+  # Default index of the same type as the one of the serial features (created by its merges)
+  transcript_feats.index = shard_feats[0].index[:0].append(pd.RangeIndex(transcript_feats.shape[0]))
+
+  return transcript_feats
+
+
+def _targetsShard(shard):
+  target_df, Y_df, time_windows, last_event_time, event_shards, query_shards = _shared_inputs["targets"]
+  return getFutureSpendings(
+    target_df[event_shards==shard], Y_df[query_shards==shard], time_windows, last_event_time)
+
+
+@instrument
+def createTargetsParallel(transcript_feats, portfolio_df, n_jobs=None, n_shards=None):
+  """ Returns the same dataframe as createTargets, calculating the future spendings of shards of the
+  persons in parallel processes
+  """
+
+  n_shards = n_shards or n_jobs or os.cpu_count()
+  last_event_time = transcript_feats["time"].max()
+  time_windows = sorted(24*portfolio_df["duration"].unique())
+
+  target_df, Y_df = getTargetEvents(transcript_feats)
+  event_shards = getShards(target_df["person"], n_shards)
+  query_shards = getShards(Y_df["person"], n_shards)
+
+  _shared_inputs["targets"] = (target_df, Y_df, time_windows, last_event_time, event_shards, query_shards)
+  try:
+    shard_spendings = runShards(_targetsShard, n_shards, n_jobs)
+  finally:
+    del _shared_inputs["targets"]
+
+  # Scatter the spendings of each shard back to its queries
+  spendings = np.zeros((Y_df.shape[0], len(time_windows)), dtype=np.float64)
+  for shard, shard_spending in enumerate(shard_spendings):
+    spendings[query_shards==shard] = shard_spending
+
+  return setTargets(Y_df, spendings, time_windows, transcript_feats)
@@ -0,0 +1,166 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import pandas as pd
+
+# Profiling is opt-in: set STARBUCKS_PROFILING=1 or call enableProfiling()
+_profiling = {"enabled": os.environ.get("STARBUCKS_PROFILING", "") == "1"}
+_profile_records = []
+_profile_lock = threading.Lock()
+_call_depth = threading.local()
+# Outermost instrumented calls running and started (in any thread), to tell the calls whose peak RSS
+# may have been reset by another thread
+_outermost_calls = {"running": 0, "started": 0}
+
+
+def enableProfiling(enabled=True):
+  """ Enables (or disables) recording the calls of instrumented functions
+  """
+
+  _profiling["enabled"] = enabled
+
+
+def profilingEnabled():
+  return _profiling["enabled"]
+
+
+def readMemoryStatus(field):
+  """ Returns a memory field (in MB) of this process status, e.g. VmRSS or VmHWM (peak RSS), or None
+  if not available (non linux systems)
+  """
+
+  try:
+    with open("/proc/self/status") as handle:
+      for line in handle:
+        if line.startswith(field + ":"):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    return None
+
+
+def resetPeakMemory():
+  """ Resets the peak RSS of the process to its current RSS (linux), returns if it was reset
+  """
+
+  try:
+    with open("/proc/self/clear_refs", "w") as handle:
+      handle.write("5")
+    return True
+  except OSError:
+    return False
+
+
+def frameShape(obj):
+  """ Returns the total number of rows and columns of the dataframes (and series) in an object,
+  which may be a tuple or list of them
+  """
+
+  if isinstance(obj, pd.DataFrame):
+    return obj.shape
+  if isinstance(obj, pd.Series):
+    return obj.shape[0], 1
+  if isinstance(obj, (tuple, list)):
+    shapes = [frameShape(item) for item in obj]
+    return sum(rows for rows, _ in shapes), sum(cols for _, cols in shapes)
+  return 0, 0
+
+
+def instrument(func):
+  """ Decorates a function to record, when profiling is enabled, the wall time, CPU time, peak RSS
+  delta and the input and output rows and columns of each call
+
+  The peak RSS is reset only by the outermost instrumented call, so nested calls report an upper
+  bound of their peak RSS delta. The peak RSS is shared by the threads of the process, so the calls
+  overlapping an outermost call of another thread are recorded with an unreliable peak RSS delta.
+  """
+
+  @functools.wraps(func)
+  def instrumented(*args, **kwargs):
+    if not _profiling["enabled"]:
+      return func(*args, **kwargs)
+
+    depth = getattr(_call_depth, "value", 0)
+    with _profile_lock:
+      if depth == 0:
+        _outermost_calls["running"] += 1
+        _outermost_calls["started"] += 1
+        resetPeakMemory()
+      running, started = _outermost_calls["running"], _outermost_calls["started"]
+    start_memory = readMemoryStatus("VmRSS")
+    start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+
+    _call_depth.value = depth + 1
+    try:
+      output = func(*args, **kwargs)
+    finally:
+      _call_depth.value = depth
+      with _profile_lock:
+        # Reliable if no other thread's outermost call was running or started meanwhile
+        rss_reliable = running == 1 and _outermost_calls["started"] == started
+        if depth == 0:
+          _outermost_calls["running"] -= 1
+
+    wall_time = time.perf_counter() - start_wall
+    cpu_time = time.process_time() - start_cpu
+    peak_memory = readMemoryStatus("VmHWM")
+    if peak_memory is not None and start_memory is not None:
+      peak_memory_delta = max(peak_memory - start_memory, 0)
+    else:
+      # ru_maxrss (kB on linux) can't be reset, so it only shows increases of the process peak
+      peak_memory_delta = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_maxrss) / 1024
+
+    input_rows, input_cols = frameShape(list(args) + list(kwargs.values()))
+    output_rows, output_cols = frameShape(output)
+
+    record = {
+      "function": f"{func.__module__}.{func.__name__}",
+      "depth": depth,
+      "start": start_time,
+      "wall_time_s": wall_time,
+      "cpu_time_s": cpu_time,
+      "peak_rss_delta_mb": peak_memory_delta,
+      "peak_rss_reliable": rss_reliable,
+      "input_rows": input_rows,
+      "input_cols": input_cols,
+      "output_rows": output_rows,
+      "output_cols": output_cols,
+    }
+    with _profile_lock:
+      _profile_records.append(record)
+
+    return output
+
+  return instrumented
+
+
+def getProfileRecords():
+  """ Returns a dataframe with the records of the instrumented calls
+  """
+
+  with _profile_lock:
+    return pd.DataFrame(list(_profile_records))
+
+
+def clearProfileRecords():
+  with _profile_lock:
+    _profile_records.clear()
+
+
+def exportProfileRecords(path=None):
+  """ Returns the records of the instrumented calls as json lines, writing them to path if given
+  """
+
+  with _profile_lock:
+    lines = "".join(json.dumps(record) + "\n" for record in _profile_records)
+
+  if path is not None:
+    with open(path, "w") as handle:
+      handle.write(lines)
+
+  return lines
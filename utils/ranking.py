@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+from .inference import *
+from .profiling import instrument
+
+
+@instrument
+def getScoreTensor(customers_spendings, n_offers, windows=inference_time_windows):
+  """ Returns the customer x offer x window array (float32) of the spendings predicted for a row per
+  customer and offer (customer major), as returned by predictCustomersSpendings
+  """
+
+  window_cols = [f"{time_window}h" for time_window in windows]
+  scores = customers_spendings[window_cols].to_numpy(dtype=np.float32)
+
+  return scores.reshape(-1, n_offers, len(windows))
+
+
+@instrument
+def rankOffers(scores, k=3, window_index=-1):
+  """ Returns the positions (in the portfolio) of the top k offers of each customer by the spending
+  predicted for a time window, and those spendings (ties are ranked by portfolio order)
+  """
+
+  window_scores = scores[:, :, window_index]
+  top_offers = np.argsort(-window_scores, axis=1, kind="stable")[:, :k]
+
+  return top_offers, np.take_along_axis(window_scores, top_offers, axis=1)
+
+
+@instrument
+def rankCustomers(customers, time, state, k=3, window=max(inference_time_windows)):
+  """ Scores every offer in the portfolio sent to each customer at the time and ranks them
+
+  Returns the scores (a row per customer and offer with the spendings of all time windows) and the
+  ranking (a row per customer and rank with the top k offers by the spending in the window).
+  """
+
+  portfolio_df = state["portfolio_df"]
+  n_offers = portfolio_df.shape[0]
+  offer_codes = pd.Categorical(portfolio_df["code"].astype(str))
+  persons = np.asarray(customers, dtype=object)
+
+  customers_spendings = predictCustomersSpendings(
+    persons, time, state["transcript_feats"], portfolio_df, state["feats_index"], state["model_version"])
+  scores = getScoreTensor(customers_spendings, n_offers)
+  top_offers, top_spendings = rankOffers(scores, k, inference_time_windows.index(window))
+
+  # Plain person ids (the categories of the compact schema would be written to every file)
+  scores_df = pd.DataFrame({
+    "person": np.repeat(persons, n_offers),
+    "offer_code": offer_codes.take(np.tile(np.arange(n_offers), len(persons))),
+  })
+  for i, time_window in enumerate(inference_time_windows):
+    scores_df[f"{time_window}h"] = scores[:, :, i].ravel()
+
+  n_ranks = top_offers.shape[1]
+  ranking_df = pd.DataFrame({
+    "person": np.repeat(persons, n_ranks),
+    "rank": np.tile(np.arange(1, n_ranks+1, dtype=np.uint8), len(persons)),
+    "offer_code": offer_codes.take(top_offers.ravel()),
+    f"{window}h": top_spendings.ravel(),
+  })
+
+  return scores_df, ranking_df
+
+
+@instrument
+def writeRankings(out_dir, state, time, k=3, window=max(inference_time_windows), chunk_size=20000):
+  """ Scores and ranks the offers for every customer of the profile at the time, writing the scores
+  and the ranking of each chunk of customers to out_dir/scores and out_dir/ranking as soon as it is
+  done, so that no more than a chunk of predictions is held in memory
+
+  Customers without events have no features and are left out (their number is written, with the
+  parameters of the run, to out_dir/meta.json). Read the results with iterPartitions/readPartitions.
+  """
+
+  for name in ["scores", "ranking"]:
+    shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+    os.makedirs(os.path.join(out_dir, name))
+
+  persons = state["profile_df"]["person"].astype(str).to_numpy(dtype=object)
+  customers = persons[pd.Index(persons).isin(state["feats_index"].index.astype(str))]
+
+  for chunk, start in enumerate(range(0, len(customers), chunk_size)):
+    scores_df, ranking_df = rankCustomers(customers[start:start+chunk_size], time, state, k, window)
+    scores_df.to_parquet(os.path.join(out_dir, "scores", f"part-{chunk:05d}.parquet"))
+    ranking_df.to_parquet(os.path.join(out_dir, "ranking", f"part-{chunk:05d}.parquet"))
+
+  meta = {
+    "time": int(time),
+    "k": k,
+    "window": f"{window}h",
+    "model_version": state["model_version"],
+    "offer_codes": [str(code) for code in state["portfolio_df"]["code"]],
+    "n_customers": len(customers),
+    "n_customers_without_events": len(persons) - len(customers),
+  }
+  with open(os.path.join(out_dir, "meta.json"), "w") as handle:
+    json.dump(meta, handle)
+
+  return meta
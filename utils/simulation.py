@@ -0,0 +1,79 @@
+from .extract_transform import *
+from .inference import *
+from .profiling import instrument
+
+# Columns of the offers simulated (as the portfolio's, with the duration in days)
+simulated_offer_cols = ["code", "type", "difficulty", "reward", "duration", "email", "mobile", "social", "web"]
+
+
+@instrument
+def simulateOffers(customers, times, offers_df, df, person_index=None):
+  """ Returns a dataframe with the model features of each offer being sent to each customer at each
+  time, indexed by person, time and offer code (customer major, then time, then offer)
+
+  The offers are rows like the portfolio's and can be new offer designs: those not in the features'
+  portfolio have no active flag of their own. The features of each customer and time are computed
+  once (as of the time, see getFeaturesAsOf) and broadcast over the offers into a float32 tensor, as
+  the offer columns are broadcast over the customers and times.
+  """
+
+  missing_cols = [col for col in simulated_offer_cols if col not in offers_df]
+  if missing_cols:
+    raise ValueError(f"Offers missing columns: {', '.join(missing_cols)}")
+  feature_cols = list(dropAuxFeatures(df.iloc[:0]).columns)
+  offer_types = [col[len("offer_type_"):] for col in feature_cols if col.startswith("offer_type_")]
+  unknown_types = set(offers_df["type"]) - set(offer_types)
+  if unknown_types:
+    raise ValueError(f"Unknown offer types: {', '.join(map(str, unknown_types))}")
+
+  customers = np.asarray(customers)
+  times = np.asarray(times)
+  n_offers = offers_df.shape[0]
+
+  # Features of the customers at the times
+  customers_feats = getFeaturesAsOf(
+    np.repeat(customers, len(times)), np.tile(times, len(customers)), df, person_index)
+  customers_matrix = dropAuxFeatures(customers_feats).to_numpy(dtype=np.float32)
+
+  # Features of the offers (as the features of the offers received)
+  offers_matrix = np.zeros((n_offers, len(feature_cols)), dtype=np.float32)
+  offer_data = getOfferFeatures(offers_df, offer_types)
+  offer_feats = [feature_cols.index(col) for col in offer_data]
+  offers_matrix[:, offer_feats] = np.column_stack(list(offer_data.values())).astype(np.float32)
+
+  # Broadcast the customers over the offers and the offers over the customers
+  tensor = np.empty((customers_matrix.shape[0], n_offers, len(feature_cols)), dtype=np.float32)
+  tensor[:] = customers_matrix[:, None, :]
+  tensor[:, :, offer_feats] = offers_matrix[None, :, offer_feats]
+  for i, code in enumerate(offers_df["code"]):
+    if f"active_{code}" in feature_cols:
+      tensor[:, i, feature_cols.index(f"active_{code}")] = 1
+
+  index = pd.MultiIndex.from_product(
+    [customers, times, offers_df["code"].astype(str)], names=["person", "time", "offer_code"])
+
+  return pd.DataFrame(tensor.reshape(-1, len(feature_cols)), index=index, columns=feature_cols)
+
+
+@instrument
+def predictSimulatedSpendings(customers, times, offers_df, df, person_index=None,
+                              model_version=default_model_version, chunk_size=10000):
+  """ Returns a dataframe with the spendings of all time windows predicted for each offer being sent
+  to each customer at each time (indexed as simulateOffers), simulating and predicting chunks of
+  customers so that only a chunk of features is held in memory
+
+  Each chunk only reads the rows of its customers, through the person offsets index of the features
+  (built once for all chunks if not given)
+  """
+
+  if person_index is None:
+    df, person_index = createPersonIndex(df)
+  customers = np.asarray(customers)
+  chunks = []
+  for start in range(0, len(customers), chunk_size):
+    X = simulateOffers(customers[start:start+chunk_size], times, offers_df, df, person_index)
+    spendings = predictSpendings(X, model_version)
+    spendings.index = X.index
+    chunks.append(spendings)
+
+  return pd.concat(chunks)
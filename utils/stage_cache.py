@@ -0,0 +1,199 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import threading
+import weakref
+from collections import OrderedDict
+import pandas as pd
+
+stage_cache_dir = ".stage_cache"
+stage_cache_max_bytes = 4 * 1024**3
+# Results kept in memory per stage (e.g. a stage run on the portfolio and on the profiles)
+stage_results_per_name = 2
+
+# Results of the stages run (or loaded) in this process by stage name and key (the least recently
+# used first), and the key of each frame returned (by id, with a weak reference to the frame so that
+# the id isn't taken as the frame's once it is freed)
+_stage_results = {}
+_frame_keys = {}
+_stage_lock = threading.RLock()
+# Lock of each stage key, held while the stage is computed or loaded
+_stage_key_locks = {}
+
+
+def fileFingerprint(path):
+  """ Returns a fingerprint of an input file given by its path, size and modification time
+  """
+
+  stat = os.stat(path)
+  return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def codeFingerprint(func):
+  """ Returns a fingerprint of the source code of the module defining a stage function (so that
+  changes to its helper functions also invalidate the stage)
+  """
+
+  source = inspect.getsource(inspect.getmodule(func))
+  return f"{func.__module__}.{func.__name__}:" + hashlib.sha256(source.encode()).hexdigest()
+
+
+def frameKey(df):
+  """ Returns the key of a dataframe: the key of the stage that produced it or, for frames not
+  returned by a stage, a hash of its contents
+  """
+
+  registered = _frame_keys.get(id(df))
+  if registered is not None and registered[1]() is df:
+    return registered[0]
+
+  content_hash = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+  content_hash.update(str(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+  return content_hash.hexdigest()
+
+
+def paramFingerprint(param):
+  """ Returns a json serializable fingerprint of a stage parameter that json can't serialize
+  """
+
+  # Categorical dtypes are identified by their categories
+  if isinstance(param, pd.CategoricalDtype):
+    return {"categories": param.categories.tolist(), "ordered": bool(param.ordered)}
+  return str(param)
+
+
+def stageKey(name, func, files=(), upstream=(), params=None):
+  """ Returns the content address of a stage: a hash of its name, code, input files, upstream stage
+  keys and parameters
+  """
+
+  key = hashlib.sha256()
+  for part in [name, codeFingerprint(func)] + [fileFingerprint(f) for f in files] + list(upstream):
+    key.update(part.encode() + b"\0")
+  key.update(json.dumps(params or {}, sort_keys=True, default=paramFingerprint).encode())
+
+  return key.hexdigest()[:32]
+
+
+def runStage(name, func, args=(), files=(), params=None, persist=True):
+  """ Returns the result of a pipeline stage (a dataframe or a tuple of dataframes), computing it
+  only if it isn't cached in this process or on disk
+
+  The frames in args are passed to the function and keyed by their upstream stage keys, the
+  params are passed as keyword arguments. Persisted results are stored as parquet files and
+  loaded with memory mapping.
+  """
+
+  key = stageKey(name, func, files, [frameKey(df) for df in args], params)
+
+  with _stage_lock:
+    results = _stage_results.setdefault(name, OrderedDict())
+    if key in results:
+      results.move_to_end(key)
+      return results[key]
+    key_lock = _stage_key_locks.setdefault(key, threading.Lock())
+
+  # Only the threads running the same stage wait for each other, independent stages run concurrently
+  with key_lock:
+    with _stage_lock:
+      if key in results:
+        results.move_to_end(key)
+        return results[key]
+
+    path = os.path.join(stage_cache_dir, f"{name}-{key}")
+    if persist and os.path.isdir(path):
+      result = readStage(path)
+      os.utime(path)
+    else:
+      result = func(*args, **(params or {}))
+      if persist:
+        writeStage(path, result)
+        with _stage_lock:
+          evictStages(keep=path)
+
+    # Register the results and the keys of the frames returned, dropping the least recently used
+    # results of the stage (frames still referenced elsewhere keep their keys)
+    with _stage_lock:
+      results[key] = result
+      while len(results) > stage_results_per_name:
+        evicted_key, _ = results.popitem(last=False)
+        _stage_key_locks.pop(evicted_key, None)
+      frames = result if isinstance(result, tuple) else (result,)
+      for i, df in enumerate(frames):
+        if isinstance(df, pd.DataFrame):
+          _frame_keys[id(df)] = (f"{key}:{i}", weakref.ref(df, forgetFrame(id(df))))
+
+    return result
+
+
+def forgetFrame(frame_id):
+  """ Returns the callback removing the key of a frame once it is freed
+  """
+
+  # Called by the garbage collector, so it doesn't take the stage lock (dict operations are atomic)
+  def callback(ref):
+    registered = _frame_keys.get(frame_id)
+    if registered is not None and registered[1] is ref:
+      _frame_keys.pop(frame_id, None)
+
+  return callback
+
+
+def writeStage(path, result):
+  """ Writes the frames of a stage result as parquet files in a directory (atomically)
+  """
+
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  os.makedirs(tmp_path, exist_ok=True)
+
+  frames = result if isinstance(result, tuple) else (result,)
+  for i, df in enumerate(frames):
+    df.to_parquet(os.path.join(tmp_path, f"part-{i}.parquet"))
+  with open(os.path.join(tmp_path, "meta.json"), "w") as handle:
+    json.dump({"n_parts": len(frames), "is_tuple": isinstance(result, tuple)}, handle)
+
+  try:
+    os.replace(tmp_path, path)
+  except OSError:
+    # Already written by another process
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def readStage(path):
+  """ Reads the frames of a stage result written by writeStage
+  """
+
+  with open(os.path.join(path, "meta.json")) as handle:
+    meta = json.load(handle)
+
+  frames = tuple(
+    pd.read_parquet(os.path.join(path, f"part-{i}.parquet"), memory_map=True)
+    for i in range(meta["n_parts"])
+  )
+
+  return frames if meta["is_tuple"] else frames[0]
+
+
+def evictStages(keep=None, max_bytes=None):
+  """ Deletes the least recently used stage results on disk until the cache fits in max_bytes
+  """
+
+  max_bytes = stage_cache_max_bytes if max_bytes is None else max_bytes
+  if not os.path.isdir(stage_cache_dir):
+    return
+
+  entries = []
+  for entry in os.scandir(stage_cache_dir):
+    if entry.is_dir() and ".tmp" not in entry.name:
+      size = sum(f.stat().st_size for f in os.scandir(entry.path))
+      entries.append((entry.stat().st_mtime, size, entry.path))
+
+  total_size = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total_size <= max_bytes:
+      break
+    if path != keep:
+      shutil.rmtree(path, ignore_errors=True)
+      total_size -= size
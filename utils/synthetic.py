@@ -0,0 +1,182 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Hours (within a 4 weeks cycle) in which offers are sent, as in the original simulation
+offer_send_cycle = [0, 168, 336, 408, 504, 576]
+offer_send_cycle_length = 672
+# Probability of a customer receiving an offer on each send
+receive_prob = 0.75
+# Ranges of membership dates and the share of customers in each of them (cohorts)
+cohort_ranges = [
+  ("2013-07-29", "2015-08-01", 0.10),
+  ("2015-08-01", "2017-08-01", 0.42),
+  ("2017-08-01", "2018-01-31", 0.28),
+  ("2018-01-31", "2018-07-26", 0.20),
+]
+
+
+def generateProfile(n_customers, seed=0):
+  """ Returns a dataframe of synthetic customers with the same records as profile.json
+  """
+
+  rng = np.random.default_rng(seed)
+
+  # Customers not informing their demographic data (age 118, no gender nor income)
+  missing = rng.random(n_customers) < 0.128
+
+  gender = rng.choice(np.array(["F", "M", "O"], dtype=object), n_customers, p=[.41, .57, .02])
+  gender[missing] = None
+
+  age = np.clip(np.round(rng.normal(55, 17, n_customers)), 18, 101).astype(int)
+  age[missing] = 118
+
+  income = np.clip(rng.normal(62000 + 400*(age-55), 18000), 30000, 120000).round(-3)
+  income[missing] = np.nan
+
+  # Membership dates sampled uniformly inside each cohort
+  cohort = rng.choice(len(cohort_ranges), n_customers, p=[share for _, _, share in cohort_ranges])
+  starts = np.array([pd.Timestamp(start).value for start, _, _ in cohort_ranges])
+  ends = np.array([pd.Timestamp(end).value for _, end, _ in cohort_ranges])
+  member_ts = starts[cohort] + rng.random(n_customers)*(ends[cohort] - starts[cohort])
+  became_member_on = pd.to_datetime(member_ts).strftime("%Y%m%d")
+
+  ids = rng.integers(0, 256, size=(n_customers, 16), dtype=np.uint8)
+
+  return pd.DataFrame({
+    "gender": gender,
+    "age": age,
+    "id": [row.tobytes().hex() for row in ids],
+    "became_member_on": became_member_on,
+    "income": income,
+  })
+
+
+def generateTranscript(profile, portfolio, n_hours=714, seed=0):
+  """ Returns a dataframe of synthetic events of the customers in profile (with the same records
+  as transcript.json) for the offers in the raw portfolio over the simulated hours
+
+  Offers are sent on the original schedule, viewed with a probability that grows with the number
+  of channels, they increase spending while valid and viewed, and bogo and discount offers are
+  completed by the transaction that makes the spending since they were received reach their
+  difficulty while valid.
+  """
+
+  rng = np.random.default_rng(seed)
+  n_customers = profile.shape[0]
+  n_offers = portfolio.shape[0]
+
+  offer_ids = portfolio["id"].to_numpy()
+  offer_hours = 24*portfolio["duration"].to_numpy().astype(np.int64)
+  offer_difficulty = portfolio["difficulty"].to_numpy()
+  offer_reward = portfolio["reward"].to_numpy()
+  offer_channels = portfolio["channels"].apply(len).to_numpy()
+
+  # Offers received
+  send_times = np.array([
+    t + cycle*offer_send_cycle_length
+    for cycle in range(n_hours // offer_send_cycle_length + 1)
+    for t in offer_send_cycle if t + cycle*offer_send_cycle_length < n_hours
+  ], dtype=np.int64)
+  is_received = rng.random((n_customers, len(send_times))) < receive_prob
+  received_person, received_send = np.nonzero(is_received)
+  received_time = send_times[received_send]
+  received_offer = rng.integers(0, n_offers, len(received_person))
+  received_end = received_time + offer_hours[received_offer]
+
+  # Offers viewed (more channels, more views) after an exponential delay while valid
+  view_prob = 0.25 + 0.15*offer_channels[received_offer]
+  view_time = received_time + np.floor(rng.exponential(24, len(received_person))).astype(np.int64)
+  is_viewed = (rng.random(len(received_person)) < view_prob) & (view_time < received_end) & (view_time < n_hours)
+
+  # Transactions: a base rate per customer plus extra transactions while viewed offers are valid
+  missing = profile["income"].isna().to_numpy()
+  rate = rng.gamma(1.5, 8.2/1.5, n_customers) * np.where(missing, 0.6, 1.0) / 714
+  n_base = rng.poisson(rate*n_hours)
+  base_person = np.repeat(np.arange(n_customers), n_base)
+  base_time = rng.integers(0, n_hours, len(base_person))
+
+  boosted = np.flatnonzero(is_viewed)
+  n_boost = rng.poisson(0.6, len(boosted))
+  boost_offer = np.repeat(boosted, n_boost)
+  boost_end = np.minimum(received_end[boost_offer], n_hours)
+  boost_time = view_time[boost_offer] + np.floor(
+    rng.random(len(boost_offer))*(boost_end - view_time[boost_offer])).astype(np.int64)
+
+  transaction_person = np.concatenate([base_person, received_person[boost_offer]])
+  transaction_time = np.concatenate([base_time, boost_time])
+  income = profile["income"].fillna(35000).to_numpy()
+  mean_amount = 1 + income[transaction_person]/5000
+  amount = np.maximum(np.round(mean_amount*rng.lognormal(-0.2, 0.6, len(transaction_person)), 2), 0.05)
+
+  # Sort transactions by person and time to find the ones completing the offers
+  time_span = n_hours + offer_hours.max() + 1
+  transaction_key = transaction_person*time_span + transaction_time
+  order = np.argsort(transaction_key, kind="stable")
+  transaction_person, transaction_time, amount = transaction_person[order], transaction_time[order], amount[order]
+  transaction_key = transaction_key[order]
+  cum_amount = np.cumsum(amount)
+
+  # First transaction (while the offer is valid) in which the spending since receiving it reaches
+  # the difficulty (informational offers have no difficulty and are never completed)
+  start = np.searchsorted(transaction_key, received_person*time_span + received_time, side="left")
+  end = np.searchsorted(transaction_key, received_person*time_span + received_end, side="left")
+  spent_before = np.where(start > 0, cum_amount[np.maximum(start-1, 0)], 0)
+  completing = np.searchsorted(cum_amount, spent_before + offer_difficulty[received_offer] - 1e-9, side="left")
+  is_completed = (offer_difficulty[received_offer] > 0) & (completing < end)
+  completed = np.flatnonzero(is_completed)
+  completed_time = transaction_time[completing[completed]]
+
+  # Assemble all events (value dicts with the same keys as the original data)
+  events = pd.concat([
+    pd.DataFrame({
+      "person": received_person, "event": "offer received", "time": received_time,
+      "value": [{"offer id": o} for o in offer_ids[received_offer]], "rank": 0,
+    }),
+    pd.DataFrame({
+      "person": received_person[is_viewed], "event": "offer viewed", "time": view_time[is_viewed],
+      "value": [{"offer id": o} for o in offer_ids[received_offer[is_viewed]]], "rank": 1,
+    }),
+    pd.DataFrame({
+      "person": transaction_person, "event": "transaction", "time": transaction_time,
+      "value": [{"amount": a} for a in amount], "rank": 2,
+    }),
+    pd.DataFrame({
+      "person": received_person[completed], "event": "offer completed", "time": completed_time,
+      "value": [
+        {"offer_id": o, "reward": int(r)}
+        for o, r in zip(offer_ids[received_offer[completed]], offer_reward[received_offer[completed]])
+      ],
+      "rank": 3,
+    }),
+  ], ignore_index=True)
+
+  events = events.sort_values(["time", "person", "rank"], kind="mergesort").reset_index(drop=True)
+  events["person"] = profile["id"].to_numpy()[events["person"].to_numpy()]
+
+  return events[["person", "event", "value", "time"]]
+
+
+def writeSyntheticDataset(out_dir, n_customers, n_hours=714, seed=0, chunk_customers=100000,
+                          portfolio_path="data/portfolio.json"):
+  """ Writes portfolio.json, profile.json and transcript.json of a synthetic dataset to out_dir,
+  generating the transcript in chunks of customers (reproducible for a given seed)
+  """
+
+  os.makedirs(out_dir, exist_ok=True)
+  shutil.copyfile(portfolio_path, os.path.join(out_dir, "portfolio.json"))
+  portfolio = pd.read_json(portfolio_path, orient='records', lines=True)
+
+  profile_seed, *chunk_seeds = np.random.SeedSequence(seed).spawn(1 + -(-n_customers // chunk_customers))
+  profile = generateProfile(n_customers, profile_seed)
+  profile.to_json(os.path.join(out_dir, "profile.json"), orient="records", lines=True)
+
+  transcript_path = os.path.join(out_dir, "transcript.json")
+  with open(transcript_path, "w") as handle:
+    for i, chunk_seed in enumerate(chunk_seeds):
+      profile_chunk = profile.iloc[i*chunk_customers:(i+1)*chunk_customers]
+      transcript = generateTranscript(profile_chunk, portfolio, n_hours, chunk_seed)
+      handle.write(transcript.to_json(orient="records", lines=True).rstrip("\n") + "\n")
+
+  return out_dir
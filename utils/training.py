@@ -0,0 +1,177 @@
+import os
+import pickle
+import re
+from concurrent.futures import ThreadPoolExecutor
+import xgboost as xgb
+from .extract_transform import *
+from .feature_store import getFeaturesAndTargets
+from .inference import *
+from .out_of_core import readPartitions
+from .profiling import instrument
+
+# Hyperparameters of the regressors: the best ones of the search in the notebook, with a lower
+# learning rate since the number of trees is chosen by early stopping
+default_params = {
+  "max_depth": 5,
+  "min_child_weight": 10,
+  "gamma": 0.5,
+  "subsample": 1.0,
+  "colsample_bytree": 0.8,
+  "learning_rate": 0.1,
+  "n_estimators": 1000,
+}
+
+
+@instrument
+def loadTrainingDataset(dataset_dir=None):
+  """ Returns the training dataset (features and targets, in the compact schema) and the time of the
+  offer of each row, from the cached stages or from the partitions written by
+  createTrainingDatasetOutOfCore to dataset_dir
+  """
+
+  if dataset_dir is not None:
+    df = readPartitions(os.path.join(dataset_dir, "df"))
+    times = readPartitions(os.path.join(dataset_dir, "df_full"), columns=["time"])["time"]
+    return df, times.to_numpy()
+
+  portfolio_df = cachedLoadAndCleanPortfolio()
+  profile_df = cachedLoadAndCleanProfile()
+  id_dtypes = createIdDtypes(portfolio_df, profile_df)
+  portfolio_df = cachedCompactFrame(portfolio_df, id_dtypes)
+  profile_df = cachedCompactFrame(profile_df, id_dtypes)
+  transcript_df = cachedLoadAndCleanTranscript(id_dtypes)
+  transcript_feats, Y_df = getFeaturesAndTargets(transcript_df, portfolio_df, profile_df)
+  df_full, df = cachedGetTrainingDataset(transcript_feats, Y_df, return_df_full=True)
+
+  return df, df_full["time"].to_numpy()
+
+
+@instrument
+def getIncrementalTargets(Y):
+  """ Returns the spending targets of exclusive time windows (the spending after the previous time
+  window up to this one), so that the cumulative spendings predicted are non-decreasing
+  """
+
+  Y_incremental = Y.astype(np.float64)
+  for prev_col, col in zip(Y.columns[:-1], Y.columns[1:]):
+    Y_incremental[col] = Y[col].astype(np.float64) - Y[prev_col].astype(np.float64)
+
+  return Y_incremental
+
+
+@instrument
+def getTimeSplit(times, labeled, valid_fraction=0.2):
+  """ Returns a mask of the validation rows: the offers received from the time splitting the rows
+  labeled for every time window (later rows lack the longest targets) at 1-valid_fraction
+  """
+
+  cutoff = np.quantile(times[labeled], 1 - valid_fraction, interpolation="higher")
+  return times >= cutoff
+
+
+def getRegressionMetrics(y_true, y_pred, weight):
+  """ Returns the rmse and r2 of the predictions of the rows with positive weight
+  """
+
+  mask = weight > 0
+  errors = y_true[mask] - y_pred[mask]
+  sum_squares = np.sum((y_true[mask] - y_true[mask].mean())**2)
+
+  return float(np.sqrt(np.mean(errors**2))), float(1 - np.sum(errors**2) / sum_squares)
+
+
+@instrument
+def trainWindowModel(target, X, y, valid, feature_names, params=None, n_threads=1, early_stopping_rounds=50,
+                     X_split=None):
+  """ Returns the model (dict with the target, regressor and its errors) of a time window
+
+  A regressor is fitted with the histogram method on the rows before the time split, stopping when
+  the error on the validation rows stops improving, and the final regressor is refitted on all the
+  rows with that number of trees. Rows with a missing target get a zero weight (so that every time
+  window shares the same feature matrices: X and its training and validation rows X_split, split
+  here if not given).
+  """
+
+  params = {**default_params, **(params or {})}
+  weight = np.isfinite(y).astype(np.float32)
+  y = np.nan_to_num(y)
+  X_train, X_valid = X_split if X_split is not None else (X[~valid], X[valid])
+
+  regressor = xgb.XGBRegressor(tree_method="hist", n_jobs=n_threads, **params)
+  regressor.fit(
+    X_train, y[~valid], sample_weight=weight[~valid],
+    eval_set=[(X_valid, y[valid])], sample_weight_eval_set=[weight[valid]],
+    early_stopping_rounds=early_stopping_rounds, verbose=False
+  )
+  rmse_train, r2_train = getRegressionMetrics(y[~valid], regressor.predict(X_train), weight[~valid])
+  rmse_test, r2_test = getRegressionMetrics(y[valid], regressor.predict(X_valid), weight[valid])
+
+  n_estimators = regressor.best_iteration + 1
+  regressor = xgb.XGBRegressor(tree_method="hist", n_jobs=n_threads, **{**params, "n_estimators": n_estimators})
+  regressor.fit(X, y, sample_weight=weight, verbose=False)
+  # Name the features as the dataframes the regressor predicts from
+  regressor.get_booster().feature_names = feature_names
+
+  return {
+    "target": target,
+    "regressor": regressor,
+    "n_estimators": n_estimators,
+    "rmse_train": rmse_train,
+    "r2_train": r2_train,
+    "rmse_test": rmse_test,
+    "r2_test": r2_test,
+  }
+
+
+@instrument
+def trainModels(df, times, n_threads=None, params=None, valid_fraction=0.2, early_stopping_rounds=50):
+  """ Returns the models of all inference time windows (in the format of loadModels), trained in
+  parallel threads sharing a thread budget and a single float32 feature matrix (and its training
+  and validation rows, split once for all time windows)
+  """
+
+  n_threads = n_threads or os.cpu_count()
+  X, Y = splitFeaturesTarget(df)
+  Y = getIncrementalTargets(Y)
+  feature_names = list(X.columns)
+  X = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+  valid = getTimeSplit(times, Y.notna().all(axis=1).to_numpy(), valid_fraction)
+  X_split = (X[~valid], X[valid])
+
+  # Split the thread budget among the time windows trained at the same time
+  n_parallel = min(len(Y.columns), n_threads)
+  window_threads = [n_threads // n_parallel + (i < n_threads % n_parallel) for i in range(len(Y.columns))]
+
+  with ThreadPoolExecutor(n_parallel) as executor:
+    futures = [
+      executor.submit(trainWindowModel, target, X, Y[target].to_numpy(), valid, feature_names, params,
+                      threads, early_stopping_rounds, X_split)
+      for target, threads in zip(Y.columns, window_threads)
+    ]
+    return [future.result() for future in futures]
+
+
+def getNextModelVersion(models_dir="models"):
+  """ Returns the version following the last one of the models in the folder (v1 if there are none)
+  """
+
+  versions = [
+    int(match.group(1)) for match in map(re.compile(r"models_v(\d+)\.pickle$").match, os.listdir(models_dir))
+    if match
+  ]
+  return f"v{max(versions, default=0) + 1}"
+
+
+@instrument
+def saveModels(models, version):
+  """ Writes the models to the file loadModels reads for the version (atomically, so that processes
+  serving the models never read a partial file)
+  """
+
+  path = getModelsPath(version)
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  with open(tmp_path, "wb") as handle:
+    pickle.dump(models, handle, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_path, path)
+
+  return path